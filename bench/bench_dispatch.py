@@ -0,0 +1,138 @@
+#coroweb请求分发的微基准测试：比较改动前每个请求都重新判断签名的RequestHandler和现在注册路由时生成binder的RequestHandler
+#只测参数提取和调用handler的开销，不经过aiohttp的网络层，request用一个只有必要属性的假对象代替
+#用法：python bench/bench_dispatch.py [次数]
+
+import os,sys,io,asyncio,logging,contextlib,time
+from urllib import parse
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','www'))
+
+from aiohttp import web
+import coroweb
+from coroweb import has_request_arg,has_var_kw_arg,has_named_kw_args,get_named_kw_args,get_required_kw_args
+from apis import APIError
+
+class FakeRequest(object):
+	def __init__(self,method='GET',query_string='',match_info=None,json=None):
+		self.method = method
+		self.query_string = query_string
+		self.match_info = match_info or {}
+		self.content_type = 'application/json' if json is not None else ''
+		self._json = json
+
+	async def json(self):
+		return self._json
+
+#改动前的RequestHandler.__call__，去掉了注释，保留了print和logging.info
+class LegacyRequestHandler(object):
+	def __init__(self,app,fn):
+		self.app = app
+		self._func = fn
+		self._has_request_arg = has_request_arg(fn)
+		self._has_var_kw_arg = has_var_kw_arg(fn)
+		self._has_named_kw_args = has_named_kw_args(fn)
+		self._name_kw_args = get_named_kw_args(fn)
+		self._required_kw_args = get_required_kw_args(fn)
+
+	async def __call__(self,request):
+		kw = None
+		if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
+			if request.method == 'POST':
+				if not request.content_type:
+					return web.HTTPBadRequest(text='Missing Content-type.')
+				ct = request.content_type.lower()
+				if ct.startswith('application/json'):
+					params = await request.json()
+					if not isinstance(params,dict):
+						return web.HTTPBadRequest(text='JSON body must be object.')
+					kw = params
+				elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+					params = await request.post()
+					kw = dict(**params)
+				else:
+					return web.HTTPBadRequest(text='Unsupported Content-Type: %s' %request.content_type)
+			if request.method == 'GET':
+				qs = request.query_string
+				if qs:
+					kw = dict()
+					for k,v in parse.parse_qs(qs,True).items():
+						kw[k] = v[0]
+		if kw is None:
+			kw = dict(**request.match_info)
+		else:
+			if not self._has_var_kw_arg and self._name_kw_args:
+				copy = dict()
+				for name in self._name_kw_args:
+					if name in kw:
+						copy[name] = kw[name]
+				kw = copy
+			for k,v in request.match_info.items():
+				if k in kw:
+					logging.warning('Duplicate arg name in named arg and kw args:%s'%k)
+				kw[k] = v
+		if self._has_request_arg:
+			kw['request'] = request
+		if self._required_kw_args:
+			for name in self._required_kw_args:
+				if not name in kw:
+					return web.HTTPBadRequest(text='Missing argument:%s'%name)
+		logging.info('call with args: %s'%str(kw))
+		try:
+			print("Aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa")
+			print(self._func)
+			print(self._func.__name__)
+			r = await self._func(**kw)
+			print(r)
+			return r
+		except APIError as e:
+			return dict(error=e.error,data=e.data,message=e.message)
+
+#和handlers.py中几类典型签名相同的处理函数
+async def get_blog(id,request):
+	return {'id':id}
+
+async def index(*,page='1',cursor=None):
+	return {'page':page}
+
+async def api_create_comment(id,request,*,content):
+	return {'id':id,'content':content}
+
+async def manage(*,page='1',**kw):
+	return kw
+
+CASES = [
+	('path only',get_blog,lambda: FakeRequest(match_info={'id':'0015'})),
+	('query',index,lambda: FakeRequest(query_string='page=2&x=1')),
+	('json body',api_create_comment,lambda: FakeRequest('POST',match_info={'id':'0015'},json={'content':'hi'})),
+	('var kw',manage,lambda: FakeRequest(query_string='page=2&q=python')),
+]
+
+def bench(loop,handler,request,number):
+	async def run():
+		for i in range(number):
+			await handler(request)
+	#取3次中最好的结果，单位为微秒每次
+	best = None
+	for i in range(3):
+		start = time.perf_counter()
+		loop.run_until_complete(run())
+		t = time.perf_counter() - start
+		best = t if best is None or t < best else best
+	return best / number * 1e6
+
+def main(argv):
+	number = int(argv[1]) if len(argv) > 1 else 20000
+	#和app.py一样使用INFO级别，改动前每个请求都会格式化一次参数
+	logging.basicConfig(level=logging.INFO,stream=io.StringIO())
+	loop = asyncio.new_event_loop()
+	print('%-10s %14s %14s %10s' % ('signature','before(us)','after(us)','speedup'))
+	for name,fn,make_request in CASES:
+		request = make_request()
+		with contextlib.redirect_stdout(io.StringIO()):
+			before = bench(loop,LegacyRequestHandler(None,fn),request,number)
+		after = bench(loop,coroweb.RequestHandler(None,fn),request,number)
+		print('%-10s %14.2f %14.2f %9.2fx' % (name,before,after,before / after))
+	loop.close()
+
+if __name__ == '__main__':
+	main(sys.argv)
@@ -0,0 +1,39 @@
+#markdown2的微基准测试：比较每次新建Markdown实例和复用池中实例的单次转换耗时
+#评论、摘要这类短文本占了我们大部分的转换，这时实例的创建成本占比最高
+#用法：python bench/bench_markdown.py [次数]
+
+import os,sys,timeit
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','www'))
+
+import markdown2
+
+TEXTS = {
+	'comment':'谢谢分享，*很有用*！',
+	'summary':'本文介绍如何用 `asyncio` 和 **aiohttp** 写一个博客，参见[教程](http://example.com)。',
+	'post':'# 标题\n\n' + '正文 *强调* `代码` [链接](http://example.com)\n\n- 列表\n- 列表\n\n' * 20,
+}
+
+EXTRAS = ['fenced-code-blocks']
+
+def bench(fn,number):
+	#取3次中最好的结果，单位为微秒每次
+	return min(timeit.repeat(fn,number=number,repeat=3)) / number * 1e6
+
+def main(argv):
+	number = int(argv[1]) if len(argv) > 1 else 2000
+	pool = markdown2.MarkdownPool()
+	md = markdown2.Markdown()
+	#每次转换前的准备工作：新建实例并reset，或者复用实例只做reset
+	setup_fresh = bench(lambda: markdown2.Markdown(extras=EXTRAS).reset(),number)
+	setup_pooled = bench(lambda: md.reset(EXTRAS),number)
+	print('setup: fresh %.2fus, pooled %.2fus' % (setup_fresh,setup_pooled))
+	print('%-10s %14s %14s %10s' % ('text','fresh(us)','pooled(us)','speedup'))
+	for name,text in TEXTS.items():
+		n = number if name != 'post' else max(number // 20,1)
+		fresh = bench(lambda: markdown2.Markdown(extras=EXTRAS).convert(text),n)
+		pooled = bench(lambda: pool.convert(text,extras=EXTRAS),n)
+		print('%-10s %14.1f %14.1f %9.2fx' % (name,fresh,pooled,fresh / pooled))
+
+if __name__ == '__main__':
+	main(sys.argv)
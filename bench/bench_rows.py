@@ -0,0 +1,60 @@
+#orm行对象的微基准测试：比较DictCursor+Model实例和tuple游标+紧凑行对象(orm.Row)
+#只测由游标返回的一行数据构造对象、读取属性的开销和每行占用的内存，不连接数据库
+#用法：python bench/bench_rows.py [行数]
+
+import os,sys,timeit,tracemalloc
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','www'))
+
+from models import Blog
+
+def make_values(n):
+	#各行除主键外共用同一组值对象，内存统计中只剩下每行对象本身的开销
+	columns = [Blog.__primary_key__] + Blog.__fields__
+	shared = ['user-id','user','about:blank','博客','摘要','# 正文','<h1>正文</h1>','markdown2',1500000000.0]
+	return columns,[['%050d' % i] + shared for i in range(n)]
+
+#DictCursor为每行创建dict，findAll再复制进Model实例
+def build_models(columns,values):
+	return [Blog._from_row(dict(zip(columns,tuple(v))),()) for v in values]
+
+#tuple游标直接返回tuple，Row只保存它的引用
+def build_rows(columns,values):
+	rowClass = Blog.__row__
+	return list(map(rowClass,[tuple(v) for v in values]))
+
+def bench(fn,number=1):
+	#取3次中最好的结果，单位为秒
+	return min(timeit.repeat(fn,number=number,repeat=3)) / number
+
+def memory(fn):
+	tracemalloc.start()
+	objs = fn()
+	size = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	del objs
+	return size
+
+def main(argv):
+	n = int(argv[1]) if len(argv) > 1 else 100000
+	columns,values = make_values(n)
+	print('%d rows of %s (%d columns)' % (n,Blog.__name__,len(columns)))
+	print('%-22s %14s %14s %10s' % ('','Model','Row','ratio'))
+	results = []
+	build_m = bench(lambda: build_models(columns,values))
+	build_r = bench(lambda: build_rows(columns,values))
+	results.append(('build (us/row)',build_m / n * 1e6,build_r / n * 1e6))
+	models = build_models(columns,values)
+	rows = build_rows(columns,values)
+	read_m = bench(lambda: [(b.name,b.summary,b.created_at) for b in models])
+	read_r = bench(lambda: [(b.name,b.summary,b.created_at) for b in rows])
+	results.append(('read 3 attrs (us/row)',read_m / n * 1e6,read_r / n * 1e6))
+	models = rows = None   #先释放，再单独测量内存
+	mem_m = memory(lambda: build_models(columns,values))
+	mem_r = memory(lambda: build_rows(columns,values))
+	results.append(('memory (bytes/row)',mem_m / n,mem_r / n))
+	for name,m,r in results:
+		print('%-22s %14.2f %14.2f %9.2fx' % (name,m,r,m / r))
+
+if __name__ == '__main__':
+	main(sys.argv)
@@ -0,0 +1,262 @@
+#整站的负载测试：在本进程内启动app(默认使用SQLite连接池，见sqlite_pool.py)，按规模写入测试数据
+#然后用若干并发的客户端按比例请求首页、博客详情页、博客列表API和发表评论API，最后以JSON输出吞吐量和各接口的p50/p95/p99延迟
+#传入--baseline时和之前保存的结果比较，吞吐量下降或p95上升超过--tolerance则以状态码1退出，可以用来发现性能回退
+#用法：
+#	python bench/loadtest.py --blogs 500 --duration 20 --output before.json
+#	python bench/loadtest.py --blogs 500 --duration 20 --baseline before.json
+#	python bench/loadtest.py --url http://127.0.0.1:9000 --cookie <awesession>   #压测已经启动的服务器(如prefork.py)
+
+import os,sys,json,time,random,asyncio,logging,argparse,tempfile
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','www'))
+
+import aiohttp
+
+#默认的请求比例，写请求(发表评论)会作废页面缓存
+DEFAULT_MIX = 'index=3,blog=4,api_blogs=2,comment=1'
+
+PARAGRAPH = '这是一段用于负载测试的正文，包含*强调*、`代码`和[链接](http://example.com)。\n\n'
+
+def parse_args(argv):
+	parser = argparse.ArgumentParser(description='Load test the blog app.')
+	parser.add_argument('--url',help='压测已经启动的服务器，不再在本进程内启动app和写入测试数据')
+	parser.add_argument('--cookie',help='配合--url使用的登录cookie，没有时不发送发表评论的请求')
+	parser.add_argument('--db',default=None,help='SQLite数据库文件，默认在临时目录中新建')
+	parser.add_argument('--users',type=int,default=20)
+	parser.add_argument('--blogs',type=int,default=200)
+	parser.add_argument('--comments',type=int,default=10,help='每篇博客的评论数')
+	parser.add_argument('--paragraphs',type=int,default=20,help='每篇博客正文的段落数')
+	parser.add_argument('--concurrency',type=int,default=32)
+	parser.add_argument('--duration',type=float,default=10,help='压测时长(秒)，不含预热')
+	parser.add_argument('--warmup',type=float,default=2,help='预热时长(秒)，期间的请求不计入结果')
+	parser.add_argument('--mix',default=DEFAULT_MIX,help='各接口的请求比例，默认为%s' % DEFAULT_MIX)
+	parser.add_argument('--pool-size',type=int,default=10)
+	parser.add_argument('--render-workers',type=int,default=None,help='渲染进程数，默认使用配置')
+	parser.add_argument('--no-page-cache',action='store_true',help='关闭整页缓存')
+	parser.add_argument('--seed',type=int,default=1)
+	parser.add_argument('--output',help='结果写入的JSON文件，默认输出到标准输出')
+	parser.add_argument('--baseline',help='用来比较的之前的结果')
+	parser.add_argument('--tolerance',type=float,default=0.1,help='允许的性能回退比例')
+	parser.add_argument('--log-level',default='WARNING')
+	return parser.parse_args(argv)
+
+def parse_mix(mix):
+	weights = {}
+	for item in mix.split(','):
+		name,weight = item.split('=')
+		if name not in ENDPOINTS:
+			raise ValueError('unknown endpoint: %s' % name)
+		weights[name] = float(weight)
+	return weights
+
+#==========================================测试数据=======================================================
+#按规模写入用户、博客和评论，第一个用户是管理员，返回(博客id列表,用于发表评论的cookie)
+async def seed(args,rnd):
+	from models import User,Blog,Comment
+	from handlers import user2cookie
+	users = []
+	for i in range(args.users):
+		users.append(User(name='user%d' % i,email='user%d@example.com' % i,passwd='0' * 40,admin=i == 0,image='about:blank',created_at=time.time() - i))
+	await User.save_many(users)
+	blogs = []
+	now = time.time()
+	for i in range(args.blogs):
+		user = users[i % len(users)]
+		blog = Blog(user_id=user.id,user_name=user.name,user_image=user.image,name='博客%d' % i,summary='第%d篇博客的摘要' % i,
+			content='# 博客%d\n\n' % i + PARAGRAPH * args.paragraphs,created_at=now - i * 60)
+		blog.render()
+		blogs.append(blog)
+	await Blog.save_many(blogs)
+	comments = []
+	for blog in blogs:
+		for j in range(args.comments):
+			user = rnd.choice(users)
+			comments.append(Comment(blog_id=blog.id,user_id=user.id,user_name=user.name,user_image=user.image,content='评论%d' % j,created_at=blog.created_at + j))
+	await Comment.save_many(comments)
+	return [b.id for b in blogs],user2cookie(users[0],86400)
+
+#从已经启动的服务器上获取博客id
+async def discover(session,url,limit=200):
+	ids = []
+	page = 1
+	while len(ids) < limit:
+		async with session.get('%s/api/blogs?page=%d' % (url,page)) as resp:
+			data = await resp.json()
+		ids.extend(b['id'] for b in data['blogs'])
+		if not data['page']['has_next']:
+			break
+		page += 1
+	return ids[:limit]
+
+#==========================================压测=======================================================
+#每个接口返回(方法,路径,请求参数)
+def req_index(rnd,ids):
+	return 'GET','/',{}
+
+def req_blog(rnd,ids):
+	return 'GET','/blog/%s' % rnd.choice(ids),{}
+
+def req_api_blogs(rnd,ids):
+	return 'GET','/api/blogs',{'params':{'page':str(rnd.randint(1,max(len(ids) // 10,1)))}}
+
+def req_comment(rnd,ids):
+	return 'POST','/api/blogs/%s/comments' % rnd.choice(ids),{'json':{'content':'负载测试评论'}}
+
+ENDPOINTS = {
+	'index':req_index,
+	'blog':req_blog,
+	'api_blogs':req_api_blogs,
+	'comment':req_comment,
+}
+
+class Recorder(object):
+	def __init__(self):
+		self.latencies = {}    #接口名 => 延迟列表(秒)
+		self.errors = {}       #接口名 => 失败次数
+		self.bytes = 0
+		self.recording = False
+
+	def add(self,name,latency,ok,size):
+		if not self.recording:
+			return
+		self.latencies.setdefault(name,[]).append(latency)
+		if not ok:
+			self.errors[name] = self.errors.get(name,0) + 1
+		self.bytes += size
+
+#sessions为接口名 => 发送请求用的ClientSession
+async def client(sessions,url,names,weights,ids,rnd,recorder,deadline):
+	while time.perf_counter() < deadline:
+		name = rnd.choices(names,weights)[0]
+		method,path,kw = ENDPOINTS[name](rnd,ids)
+		start = time.perf_counter()
+		try:
+			async with sessions[name].request(method,url + path,allow_redirects=False,**kw) as resp:
+				body = await resp.read()
+				#API出错时也返回200，错误信息在JSON的error字段中
+				ok = resp.status < 400 and not (resp.content_type == 'application/json' and b'"error"' in body[:20])
+				size = len(body)
+		except aiohttp.ClientError:
+			ok,size = False,0
+		recorder.add(name,time.perf_counter() - start,ok,size)
+
+def percentile(sorted_values,p):
+	if not sorted_values:
+		return None
+	k = max(int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1,0)
+	return sorted_values[min(k,len(sorted_values) - 1)]
+
+def summarize(latencies,errors,elapsed):
+	values = sorted(latencies)
+	ms = lambda v: None if v is None else round(v * 1000,3)
+	return {
+		'requests':len(values),
+		'errors':errors,
+		'throughput':round(len(values) / elapsed,2),
+		'mean_ms':ms(sum(values) / len(values) if values else None),
+		'p50_ms':ms(percentile(values,50)),
+		'p95_ms':ms(percentile(values,95)),
+		'p99_ms':ms(percentile(values,99)),
+		'max_ms':ms(values[-1] if values else None),
+	}
+
+async def run_load(args,url,ids,cookie):
+	weights = parse_mix(args.mix)
+	if not cookie:
+		weights.pop('comment',None)
+	names = list(weights)
+	recorder = Recorder()
+	#读接口以匿名用户访问，这样才会走整页缓存(--no-page-cache才有意义)；只有发表评论带登录cookie
+	#两个session共用一个连接池，并发连接数仍然不超过concurrency
+	connector = aiohttp.TCPConnector(limit=args.concurrency)
+	anonymous = aiohttp.ClientSession(connector=connector,connector_owner=False)
+	signed_in = aiohttp.ClientSession(connector=connector,connector_owner=False,cookies={'awesession':cookie} if cookie else None)
+	sessions = dict((name,signed_in if name == 'comment' else anonymous) for name in names)
+	async with connector,anonymous,signed_in:
+		start = time.perf_counter()
+		deadline = start + args.warmup + args.duration
+		clients = [client(sessions,url,names,[weights[n] for n in names],ids,random.Random(args.seed + i),recorder,deadline)
+			for i in range(args.concurrency)]
+		async def start_recording():
+			await asyncio.sleep(args.warmup)
+			recorder.recording = True
+			return time.perf_counter()
+		results = await asyncio.gather(start_recording(),*clients)
+		elapsed = time.perf_counter() - results[0]
+	report = {'endpoints':{}}
+	for name in names:
+		report['endpoints'][name] = summarize(recorder.latencies.get(name,[]),recorder.errors.get(name,0),elapsed)
+	every = [v for values in recorder.latencies.values() for v in values]
+	report['overall'] = summarize(every,sum(recorder.errors.values()),elapsed)
+	report['overall']['response_bytes'] = recorder.bytes
+	report['elapsed'] = round(elapsed,3)
+	return report
+
+#==========================================与基准比较=======================================================
+#返回回退的指标列表，每一项为(名称,基准值,当前值)
+def compare(baseline,report,tolerance):
+	regressions = []
+	for name,current in [('overall',report['overall'])] + sorted(report['endpoints'].items()):
+		base = baseline['overall'] if name == 'overall' else baseline['endpoints'].get(name)
+		if not base or not base['requests'] or not current['requests']:
+			continue
+		if current['throughput'] < base['throughput'] * (1 - tolerance):
+			regressions.append(('%s.throughput' % name,base['throughput'],current['throughput']))
+		if current['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+			regressions.append(('%s.p95_ms' % name,base['p95_ms'],current['p95_ms']))
+	return regressions
+
+async def main(args):
+	logging.basicConfig(level=getattr(logging,args.log_level.upper()))
+	rnd = random.Random(args.seed)
+	config = dict((k,v) for k,v in vars(args).items() if k not in ('output','baseline','cookie'))
+	if args.url:
+		url = args.url.rstrip('/')
+		async with aiohttp.ClientSession() as session:
+			ids = await discover(session,url)
+		report = await run_load(args,url,ids,args.cookie)
+	else:
+		import app,orm,sqlite_pool
+		from models import User,Blog,Comment
+		from cache import page_cache
+		path = args.db or os.path.join(tempfile.mkdtemp(prefix='awesome-bench-'),'bench.db')
+		pool = await sqlite_pool.create_pool(path,[User,Blog,Comment],maxsize=args.pool_size)
+		orm.set_pool(pool)
+		seed_start = time.perf_counter()
+		ids,cookie = await seed(args,rnd)
+		config['seed_seconds'] = round(time.perf_counter() - seed_start,3)
+		if args.no_page_cache:
+			page_cache.maxsize = 0
+		loop = asyncio.get_event_loop()
+		application = await app.create_app(loop,render_workers=args.render_workers,db_pool=pool)
+		handler = application.make_handler()
+		server = await loop.create_server(handler,'127.0.0.1',0)
+		url = 'http://127.0.0.1:%d' % server.sockets[0].getsockname()[1]
+		try:
+			report = await run_load(args,url,ids,cookie)
+		finally:
+			server.close()
+			await server.wait_closed()
+			await handler.shutdown(1.0)
+			await application.cleanup()
+			app.renderer.shutdown_renderer()
+			pool.close()
+	report['config'] = config
+	return report
+
+if __name__ == '__main__':
+	args = parse_args(sys.argv[1:])
+	loop = asyncio.get_event_loop()
+	report = loop.run_until_complete(main(args))
+	text = json.dumps(report,indent=2,ensure_ascii=False,sort_keys=True)
+	if args.output:
+		with open(args.output,'w') as f:
+			f.write(text + '\n')
+	else:
+		print(text)
+	if args.baseline:
+		with open(args.baseline) as f:
+			regressions = compare(json.load(f),report,args.tolerance)
+		for name,base,current in regressions:
+			print('regression: %s %s -> %s' % (name,base,current),file=sys.stderr)
+		sys.exit(1 if regressions else 0)
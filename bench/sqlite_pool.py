@@ -0,0 +1,128 @@
+#基于SQLite的连接池，接口和orm用到的aiomysql连接池相同，用于在没有MySQL的机器上跑基准测试
+#SQL语句和MySQL的差别只有占位符：orm把?换成了%s，这里再换回来；SQLite也接受`反引号`和limit offset,count写法
+#SQLite的调用是同步的，会阻塞事件循环，测出来的数据库耗时和MySQL没有可比性，只适合比较同一台机器上不同版本的web层开销
+
+import asyncio,sqlite3
+
+def _dict_row(cursor,row):
+	return dict((d[0],v) for d,v in zip(cursor.description,row))
+
+#由Model的__mappings__和__indexes__生成SQLite的建表和建索引语句
+def create_table_sql(model):
+	columns = []
+	for attr,field in model.__mappings__.items():
+		columns.append('`%s` %s' % (field.name or attr,field.column_type))
+	return 'create table if not exists `%s` (%s, primary key (`%s`))' % (model.__table__,', '.join(columns),model.__primary_key__)
+
+#SQLite中索引名在整个数据库内唯一，加上表名作为前缀
+def create_index_sqls(model):
+	return ['create %sindex if not exists `%s_%s` on `%s` (%s)' % ('unique ' if index.unique else '',model.__table__,index.name,model.__table__,
+		', '.join('`%s`' % c for c in index.columns)) for index in model.__indexes__]
+
+class Cursor(object):
+	def __init__(self,conn,dict_rows):
+		self._cur = conn.cursor()
+		if dict_rows:
+			self._cur.row_factory = _dict_row
+		self.rowcount = -1
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self,*exc):
+		self._cur.close()
+
+	async def execute(self,sql,args=()):
+		self._cur.execute(sql.replace('%s','?'),tuple(args or ()))
+		self.rowcount = self._cur.rowcount
+
+	async def fetchone(self):
+		return self._cur.fetchone()
+
+	async def fetchmany(self,size):
+		return self._cur.fetchmany(size)
+
+	async def fetchall(self):
+		return self._cur.fetchall()
+
+class Connection(object):
+	def __init__(self,path):
+		#isolation_level=None表示自动提交，和orm的连接池设置相同，事务由begin()显式开启
+		self._conn = sqlite3.connect(path,isolation_level=None,check_same_thread=False)
+		self._conn.execute('pragma journal_mode=wal')
+		self._conn.execute('pragma synchronous=off')
+
+	#cursorclass为aiomysql的游标类，名字中带Dict的返回dict，否则返回tuple
+	def cursor(self,cursorclass=None):
+		return Cursor(self._conn,cursorclass is not None and 'Dict' in cursorclass.__name__)
+
+	async def begin(self):
+		self._conn.execute('begin')
+
+	async def commit(self):
+		self._conn.execute('commit')
+
+	async def rollback(self):
+		self._conn.execute('rollback')
+
+	def close(self):
+		self._conn.close()
+
+class _Acquire(object):
+	def __init__(self,pool):
+		self._pool = pool
+		self._conn = None
+
+	async def __aenter__(self):
+		self._conn = await self._pool.acquire()
+		return self._conn
+
+	async def __aexit__(self,*exc):
+		self._pool.release(self._conn)
+
+class SQLitePool(object):
+	def __init__(self,path,maxsize=10):
+		self.path = path
+		self.maxsize = maxsize
+		self._free = []
+		self._size = 0
+		self._waiters = []
+
+	async def acquire(self):
+		while not self._free and self._size >= self.maxsize:
+			fut = asyncio.get_event_loop().create_future()
+			self._waiters.append(fut)
+			await fut
+		if self._free:
+			return self._free.pop()
+		self._size += 1
+		return Connection(self.path)
+
+	def release(self,conn):
+		self._free.append(conn)
+		while self._waiters:
+			fut = self._waiters.pop(0)
+			if not fut.done():
+				fut.set_result(None)
+				break
+
+	def get(self):
+		return _Acquire(self)
+
+	def close(self):
+		for conn in self._free:
+			conn.close()
+		self._free = []
+
+	async def wait_closed(self):
+		pass
+
+#创建数据库文件和各个Model的表，返回连接池
+async def create_pool(path,models,maxsize=10):
+	pool = SQLitePool(path,maxsize)
+	async with pool.get() as conn:
+		for model in models:
+			for sql in [create_table_sql(model)] + create_index_sqls(model):
+				async with conn.cursor() as cur:
+					await cur.execute(sql)
+	return pool
@@ -1,4 +1,4 @@
-import json,logging,inspect,functools
+import json,logging,inspect,functools,base64
 
 #Page类用于存储分页信息
 class Page(object):
@@ -35,6 +35,77 @@ class Page(object):
 
 	__repr__ = __str__
 	
+#游标是把(方向,created_at,id)序列化为json后再做urlsafe的base64编码，对前端来说是不透明的字符串
+def encode_cursor(direction,created_at,id):
+	s = json.dumps([direction,created_at,id],separators=(',',':'))
+	return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+	try:
+		s = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+		direction,created_at,id = json.loads(s)
+		if direction not in ('next','prev'):
+			raise ValueError(direction)
+		return direction,(float(created_at),str(id))
+	except (ValueError,TypeError):
+		raise APIValueError('cursor','Invalid cursor.')
+
+#CursorPage类用于keyset(游标)分页，列表按(created_at,id)降序排列
+#不需要count(id)统计总数，也不需要offset，任何一页的代价都和第一页相同
+class CursorPage(object):
+
+	keyset = True
+
+	def __init__(self,cursor=None,page_size=10):
+		'''
+		init Pagination by cursor,page_size
+		cursor - 上一次返回的next_cursor或prev_cursor，为空表示第一页
+		page_size - 一个页面最多能显示博客的数目
+		'''
+		self.page_size = page_size
+		self.cursor = cursor or None
+		self.after = None      #传给findAll的after参数
+		self.before = None     #传给findAll的before参数
+		if self.cursor:
+			direction,key = decode_cursor(self.cursor)
+			if direction == 'prev':
+				self.before = key
+			else:
+				self.after = key
+		self.limit = page_size + 1   #多取一条，用来判断后面是否还有数据
+		self.has_next = False
+		self.has_previous = False
+		self.next_cursor = None
+		self.prev_cursor = None
+
+	#传入findAll按limit取回的结果，去掉多取的那一条并计算前后页的游标，返回本页的数据
+	def paginate(self,items):
+		items = list(items)
+		more = len(items) > self.page_size
+		if self.before is not None:
+			#向前翻页时多取的那一条在最前面
+			if more:
+				items = items[len(items) - self.page_size:]
+			self.has_previous = more
+			self.has_next = True
+		else:
+			if more:
+				items = items[:self.page_size]
+			self.has_next = more
+			self.has_previous = self.after is not None
+		if items:
+			if self.has_next:
+				self.next_cursor = encode_cursor('next',items[-1].created_at,items[-1].id)
+			if self.has_previous:
+				self.prev_cursor = encode_cursor('prev',items[0].created_at,items[0].id)
+		return items
+
+	def __str__(self):
+		return 'cursor: %s,page_size: %s,has_next: %s,has_previous: %s' % \
+			(self.cursor,self.page_size,self.has_next,self.has_previous)
+
+	__repr__ = __str__
+
 #简单的api错误异常类，用于抛出错误
 '''
 JSON API definintion.
@@ -2,26 +2,36 @@
 #logging模块可以记录错误信息，并在错误信息记录完后继续执行
 import logging; logging.basicConfig(level=logging.INFO)
 #asyncio内置了对异步IO的支持，os模块提供了调用操作系统的接口函数，json模块提供了Python对象到Json模块的转换
-import asyncio,os,json,time
+import asyncio,os,json,time,gzip,zlib
 from datetime import datetime
 #aiohttp是基于asyncio实现的http框架
 from aiohttp import web
 #Jinja2是仿照Django模板的Python前端引擎模板
 #Evironment指的是jinja2模板的配置环境，FileSystemLoader是文件系统加载器，用来加载模板路径
-from jinja2 import Environment,FileSystemLoader
+from jinja2 import Environment,FileSystemLoader,FileSystemBytecodeCache
+
+#brotli是可选的，没有安装时只使用gzip/deflate
+try:
+	import brotli
+except ImportError:
+	brotli = None
 
 import orm
-from coroweb import add_routes,add_static
+import renderer
+import metrics
+import assets
+from config import configs
+from coroweb import add_routes,add_static,make_etag,http_date,not_modified
 
 from handlers import cookie2user,COOKIE_NAME
+from cache import page_cache
 
 '''
 def index(request):
 	return web.Response(body=b'<h1>Awesome</h1>',content_type='text/html')
 '''
-#定义一个初始化jiaja2模板，配置jinja2的环境
-def init_jinja2(app,**kw):
-	logging.info('init jinja2...')
+#创建jinja2的环境，compile_templates.py也使用它来预编译模板
+def create_jinja2_env(**kw):
 	#设置解析模板需要用到的环境变量
 	options = dict(
 		autoescape = kw.get('autoescape',True),  #自动转义xml/html的特殊字符
@@ -41,13 +51,91 @@ def init_jinja2(app,**kw):
 		#os.path.join(path,name)把目录和名字组合
 		path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'templates')
 	logging.info('set jinja2 template path:%s'%path)
+	#字节码缓存：模板编译后的字节码保存在这个目录下，进程冷启动时直接读取，不用重新编译
+	bytecode_cache_dir = kw.get('bytecode_cache_dir',None)
+	if bytecode_cache_dir:
+		if not os.path.isdir(bytecode_cache_dir):
+			os.makedirs(bytecode_cache_dir)
+		logging.info('set jinja2 bytecode cache path:%s'%bytecode_cache_dir)
+		options['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache_dir)
 	#loader=FileSystemLoader(path)指的是到哪个目录下加载模板文件，**options就是前面的options
 	env = Environment(loader=FileSystemLoader(path),**options)
 	filters = kw.get('filters',None)  #filters=>过滤器
 	if filters is not None:
 		for name, f in filters.items():
 			env.filters[name] = f  #在env中添加过滤器
+	env.globals.update(kw.get('globals',None) or {})   #模板中可以直接调用的全局函数
+	return env
+
+#加载模板目录下的全部模板，返回 模板名 => 模板对象 的dict
+def load_templates(env):
+	return dict((name,env.get_template(name)) for name in env.list_templates(extensions=['html']))
+
+#定义一个初始化jiaja2模板，配置jinja2的环境
+def init_jinja2(app,**kw):
+	logging.info('init jinja2...')
+	env = create_jinja2_env(**kw)
 	app['__templating__'] = env    #前面已经把jinja2的环境配置都复制给env了，这里再把env存入app的dict中，这样app就知道要去哪找模板，怎么解析模板
+	#生产模式(不自动重新加载)下，启动时就把所有模板加载好，之后整个进程都使用这些模板对象，不再检查模板文件的变化
+	app['__templates__'] = None if env.auto_reload else load_templates(env)
+	#模板的版本，参与计算handler给出的ETag，模板修改后旧的ETag全部失效
+	#调试模式下模板随时可能变化，没有固定的版本，只能根据渲染结果计算ETag
+	if env.auto_reload:
+		app['__templates_version__'] = None
+	else:
+		app['__templates_version__'] = make_etag(*[env.loader.get_source(env,name)[0] for name in sorted(app['__templates__'])])
+
+#根据模板名取得模板对象，生产模式下直接使用启动时加载好的模板
+def get_template(app,name):
+	templates = app['__templates__']
+	if templates is not None and name in templates:
+		return templates[name]
+	return app['__templating__'].get_template(name)
+
+#响应体的字节数(压缩后)，流式响应在handler中已经写完，使用已写入的长度
+def response_size(r):
+	if r is None:
+		return 0
+	if r.prepared:
+		return getattr(r,'body_length',0)
+	body = getattr(r,'body',None)
+	if isinstance(body,(bytes,bytearray)):
+		return len(body)
+	return r.content_length or 0
+
+#json无法直接序列化的对象：orm的紧凑行对象转为dict，其他对象(如Page)使用__dict__
+def json_default(o):
+	if isinstance(o,orm.Row):
+		return o._asdict()
+	return o.__dict__
+
+#请求的指标：按路由统计的延迟、状态码和请求/响应大小，以及正在处理的请求数，由/metrics输出
+#放在最外层，统计的时间包括所有中间件，但不包括把响应写入socket的时间
+@asyncio.coroutine
+def metrics_factory(app,handler):
+	@asyncio.coroutine
+	def record(request):
+		#按注册路由时的路径模式统计；静态文件和没有匹配的路径各归为一类
+		route = getattr(request.match_info.handler,'__route__',None)
+		if route is None:
+			route = '/static/' if request.path.startswith('/static/') else 'unmatched'
+		start = time.perf_counter()
+		metrics.http_in_flight.inc()
+		r = None
+		try:
+			r = yield from handler(request)
+			return r
+		except web.HTTPException as e:   #重定向、404等以异常的形式返回
+			r = e
+			raise
+		finally:
+			metrics.http_in_flight.dec()
+			status = str(r.status) if r is not None else '500'
+			metrics.http_request_seconds.observe(time.perf_counter() - start,request.method,route)
+			metrics.http_requests.inc(request.method,route,status)
+			metrics.http_request_bytes.observe(request.content_length or 0,request.method,route)
+			metrics.http_response_bytes.observe(response_size(r),request.method,route)
+	return record
 
 #这个函数的作用就是当http请求的时候通过logging.info输出请求的信息，其中包括请求的方法和路径
 @asyncio.coroutine
@@ -93,12 +181,205 @@ def data_factory(app,handler):
 	return parse_data
 
 
+#响应压缩
+#只压缩不小于COMPRESS_MIN_SIZE字节、类型为文本类的响应，body超过COMPRESS_OFFLOAD_SIZE字节时放到线程池中压缩，不占用事件循环
+#静态文件不经过这里：aiohttp会直接发送precompress_static.py预先生成的.br/.gz文件
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_OFFLOAD_SIZE = 64 * 1024
+COMPRESS_TYPES = ('text/','application/json','application/javascript','image/svg+xml')
+
+#根据Accept-Encoding选择压缩方式，按codings的顺序优先(默认br，其次gzip、deflate)，q=0表示客户端不接受
+def choose_encoding(accept_encoding,codings=('br','gzip','deflate')):
+	accepted = set()
+	for item in accept_encoding.lower().split(','):
+		parts = item.strip().split(';')
+		q = 1.0
+		for p in parts[1:]:
+			p = p.strip()
+			if p.startswith('q='):
+				try:
+					q = float(p[2:])
+				except ValueError:
+					q = 0.0
+		if q > 0:
+			accepted.add(parts[0].strip())
+	for coding in codings:
+		if coding in accepted and (coding != 'br' or brotli is not None):
+			return coding
+	return None
+
+def compress_body(body,coding):
+	if coding == 'br':
+		return brotli.compress(body)
+	if coding == 'gzip':
+		return gzip.compress(body,compresslevel=6)
+	return zlib.compress(body,6)
+
+@asyncio.coroutine
+def compress_factory(app,handler):
+	@asyncio.coroutine
+	def compress(request):
+		r = yield from handler(request)
+		if not isinstance(r,web.Response) or r.body is None or not isinstance(r.body,bytes):
+			return r
+		if len(r.body) < COMPRESS_MIN_SIZE or 'Content-Encoding' in r.headers:
+			return r
+		if not r.headers.get('Content-Type','').startswith(COMPRESS_TYPES):
+			return r
+		coding = choose_encoding(request.headers.get('Accept-Encoding',''))
+		r.headers['Vary'] = 'Accept-Encoding'
+		if coding is None:
+			return r
+		if len(r.body) >= COMPRESS_OFFLOAD_SIZE:
+			#zlib和brotli压缩时会释放GIL，放到线程池中不会阻塞事件循环
+			body = yield from asyncio.get_event_loop().run_in_executor(None,compress_body,r.body,coding)
+		else:
+			body = compress_body(r.body,coding)
+		r.body = body
+		r.headers['Content-Encoding'] = coding
+		#压缩后的表示和原始表示字节不同，强ETag变为弱ETag
+		etag = r.headers.get('ETag')
+		if etag and not etag.startswith('W/'):
+			r.headers['ETag'] = 'W/' + etag
+		return r
+	return compress
+
+#条件GET：给GET请求的200响应加上ETag(handler没有给出时根据body计算)
+#请求带有匹配的If-None-Match或未过期的If-Modified-Since时返回304，不再发送body
+#放在page_cache_factory之前，整页缓存命中的响应也能得到ETag
+@asyncio.coroutine
+def etag_factory(app,handler):
+	@asyncio.coroutine
+	def etag(request):
+		request.__etag__ = None            #由response_factory根据handler给出的版本设置
+		request.__last_modified__ = None
+		r = yield from handler(request)
+		if request.method != 'GET' or not isinstance(r,web.Response) or r.status != 200:
+			return r
+		if 'ETag' not in r.headers:
+			tag = request.__etag__
+			if tag is None and r.body is not None:
+				tag = make_etag(r.body)
+			if tag is None:
+				return r
+			r.headers['ETag'] = tag
+		if request.__last_modified__ and 'Last-Modified' not in r.headers:
+			r.headers['Last-Modified'] = request.__last_modified__
+		if not_modified(request,r.headers['ETag'],r.headers.get('Last-Modified')):
+			return web.HTTPNotModified(headers=validator_headers(r.headers['ETag'],r.headers.get('Last-Modified')))
+		return r
+	return etag
+
+def validator_headers(etag,last_modified):
+	headers = {'ETag':etag}
+	if last_modified:
+		headers['Last-Modified'] = last_modified
+	return headers
+
+#handler返回的dict中可以用'__etag__'给出页面的版本(如博客的内容和评论)，'__last_modified__'给出最后修改的时间戳
+#这样在渲染模板之前就能判断客户端的缓存是否有效
+def handler_validators(app,r):
+	etag = None
+	if r.get('__etag__') is not None:
+		if r.get('__template__') is None:
+			etag = make_etag(r['__etag__'])
+		elif app['__templates_version__'] is not None:
+			etag = make_etag(app['__templates_version__'],r['__etag__'])
+	last_modified = r.get('__last_modified__')
+	return etag,None if last_modified is None else http_date(last_modified)
+
+#整页缓存，放在auth_factory之后(需要知道是不是匿名用户)、response_factory之前(缓存渲染好的结果)
+#handler返回的dict中带有'__cache_tags__'时，匿名用户的GET结果会被缓存，见cache.PageCache
+@asyncio.coroutine
+def page_cache_factory(app,handler):
+	@asyncio.coroutine
+	def page_cache_handler(request):
+		request.__page_cacheable__ = request.method == 'GET' and request.__user__ is None
+		if not request.__page_cacheable__:
+			return (yield from handler(request))
+		key = request.path_qs
+		entry = page_cache.get(key)
+		if entry is not None:
+			body,content_type,tags,etag = entry
+			#命中时使用和未命中时相同的ETag，避免客户端的缓存因为ETag不同而失效
+			request.__etag__ = etag
+			return web.Response(body=body,headers={'Content-Type':content_type})
+		generation = page_cache.generation
+		request.__cache_tags__ = None   #由response_factory根据handler的返回值设置
+		r = yield from handler(request)
+		if request.__cache_tags__ and isinstance(r,web.Response) and r.status == 200 and r.body is not None:
+			page_cache.put(key,r.body,r.headers.get('Content-Type'),request.__cache_tags__,generation,getattr(request,'__etag__',None))
+		return r
+	return page_cache_handler
+
+#流式渲染时，累积到这么多字符才写一次，避免每个小片段都触发一次发送
+STREAM_CHUNK_SIZE = 8192
+#流式响应只用zlib压缩，每次写入后都要Z_SYNC_FLUSH
+STREAM_CODINGS = ('gzip','deflate')
+
+#流式响应的压缩器，gzip和deflate的格式与compress_body相同
+def stream_compressor(coding):
+	return zlib.compressobj(6,zlib.DEFLATED,31 if coding == 'gzip' else 15)
+
+#流式渲染模板：用template.generate()边渲染边通过StreamResponse发送
+#</head>及之前的部分一渲染出来就立即发送，浏览器可以在body还在渲染时就开始加载/static/下的css和js
+#注意：一旦开始发送就无法再修改状态码，渲染中途出错时只能记录日志并结束响应
+@asyncio.coroutine
+def stream_template(request,template,context):
+	resp = web.StreamResponse()
+	resp.content_type = 'text/html'
+	resp.charset = 'utf-8'
+	#发送之后就不能再加header了，ETag要在prepare之前设置
+	if getattr(request,'__etag__',None):
+		resp.headers['ETag'] = 'W/' + request.__etag__   #可能被压缩，使用弱ETag
+	#流式响应无法经过compress_factory，在这里边发送边压缩
+	#不能用resp.enable_compression()：aiohttp的压缩器会把数据攒在缓冲区里，</head>不能及时发出去
+	#自己的压缩器每次写入后都Z_SYNC_FLUSH，已经渲染的部分全部输出
+	coding = choose_encoding(request.headers.get('Accept-Encoding',''),STREAM_CODINGS)
+	resp.headers['Vary'] = 'Accept-Encoding'
+	compressor = None
+	if coding is not None:
+		resp.headers['Content-Encoding'] = coding
+		compressor = stream_compressor(coding)
+	yield from resp.prepare(request)
+	def encode(chunks):
+		data = ''.join(chunks).encode('utf-8')
+		if compressor is not None:
+			data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+		return data
+	buf = []
+	size = 0
+	head_sent = False
+	try:
+		for s in template.generate(**context):
+			buf.append(s)
+			size += len(s)
+			if size >= STREAM_CHUNK_SIZE or (not head_sent and '</head>' in s):
+				head_sent = True
+				#每次write都会让出事件循环，渲染大页面时其他连接也能得到处理
+				yield from resp.write(encode(buf))
+				buf = []
+				size = 0
+		if buf:
+			yield from resp.write(encode(buf))
+	except Exception as e:
+		logging.exception(e)
+	if compressor is not None:
+		yield from resp.write(compressor.flush())
+	yield from resp.write_eof()
+	return resp
+
 @asyncio.coroutine
 def response_factory(app,handler):
 	@asyncio.coroutine
 	def response(request):
 		logging.info('Response handler...')
 		r = yield from handler(request)
+		#handler给出了版本时，先检查条件请求，缓存有效就直接返回304，连模板都不用渲染
+		if isinstance(r,dict) and ('__etag__' in r or '__last_modified__' in r):
+			request.__etag__,request.__last_modified__ = handler_validators(app,r)
+			if request.method == 'GET' and not_modified(request,request.__etag__,request.__last_modified__):
+				return web.HTTPNotModified(headers=validator_headers(request.__etag__,request.__last_modified__))
 		#如果结果为StreamResponse,直接返回
 		#StreamResponse是aiohttp定义response的基类，即所有响应类型都继承自该类
 		#StreamResponse主要为流式数据而设计
@@ -123,12 +404,19 @@ def response_factory(app,handler):
 			template = r.get('__template__')
 			#若不存在对应模板，则将字典调整为json格式返回，并设置响应类型为json
 			if template is None:
-				resp = web.Response(body=json.dumps(r,ensure_ascii=False,default=lambda o:o.__dict__).encode('utf-8'))
+				resp = web.Response(body=json.dumps(r,ensure_ascii=False,default=json_default).encode('utf-8'))
 				resp.content_type = 'application/json;charset=utf-8'
 				return resp
 			else:
 				r["__user__"] = request.__user__  #增加__user__，前端页面将依次来决定是否显示评论框
-				resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
+				#页面可以被缓存时告诉page_cache_factory它的标签，这时需要完整的body，不能流式渲染
+				cacheable = r.get('__cache_tags__') and getattr(request,'__page_cacheable__',False)
+				if cacheable:
+					request.__cache_tags__ = r['__cache_tags__']
+				#handler返回'__stream__':True时使用流式渲染，适合评论很多的长页面
+				if r.get('__stream__') and not cacheable:
+					return (yield from stream_template(request,get_template(app,template),r))
+				resp = web.Response(body=get_template(app,template).render(**r).encode('utf-8'))
 				resp.content_type = 'text/html;charset=utf-8'
 				return resp
 		#如果响应结果为整数类型，且在100和600之间,则此时r为状态码，即404,500等
@@ -161,31 +449,63 @@ def datetime_filter(t):
 	dt = datetime.fromtimestamp(t)
 	return u'%s年%s月%s日' %(dt.year,dt.month,dt.day)
 
+#模板中用到的过滤器和全局函数
+TEMPLATE_FILTERS = dict(datetime=datetime_filter,static=assets.static_url)
+TEMPLATE_GLOBALS = dict(static_url=assets.static_url)
+
+#调试模式下模板文件修改后自动重新加载；否则使用字节码缓存，并在启动时加载全部模板
+def jinja2_options():
+	if configs.debug:
+		return dict(filters=TEMPLATE_FILTERS,globals=TEMPLATE_GLOBALS,auto_reload=True)
+	return dict(filters=TEMPLATE_FILTERS,globals=TEMPLATE_GLOBALS,auto_reload=False,bytecode_cache_dir=configs.templates.bytecode_cache_dir)
+
+#创建数据库连接池和app对象，但不启动服务器，prefork.py的每个worker都用它创建自己的app
+#pool_maxsize为本进程的数据库连接数上限，render_workers为本进程的渲染进程数，None表示使用配置
+#db_pool不为None时使用传入的连接池(如基准测试使用的SQLite连接池)，不再连接MySQL
 @asyncio.coroutine
-def init(loop):
+def create_app(loop,pool_maxsize=10,render_workers=None,db_pool=None):
 	#创建数据库连接池
-	yield from orm.create_pool(loop=loop,host='127.0.0.1',port=3306,user='www-data',password='www-data',db='awesome')
+	if db_pool is None:
+		yield from orm.create_pool(loop=loop,host='127.0.0.1',port=3306,user='www-data',password='www-data',db='awesome',maxsize=pool_maxsize)
+	else:
+		orm.set_pool(db_pool)
+	orm.query_log = orm.QueryLog(sample_rate=configs.sql.sample_rate,slow_threshold=configs.sql.slow_ms / 1000.0,
+		explain=configs.sql.explain,maxlen=configs.sql.slow_log_size)
 	#创建app对象，同时传入上文定义的拦截器middlewares
 	app = web.Application(loop=loop,middlewares=[
-		logger_factory,auth_factory,response_factory
+		metrics_factory,logger_factory,compress_factory,auth_factory,etag_factory,page_cache_factory,response_factory
 		])
 
+	#启动markdown渲染进程池
+	render_options = dict(configs.render)
+	if render_workers is not None:
+		render_options['workers'] = render_workers
+	renderer.init_renderer(**render_options)
 	#初始化jinja2模板，并传入时间过滤器
-	init_jinja2(app,filters=dict(datetime=datetime_filter))
+	init_jinja2(app,**jinja2_options())
 	add_routes(app,'handlers')    #自动把handlers模块的所有符合条件的函数注册了
 	add_static(app)
+	#调试模式下静态文件随时会修改，不使用带哈希的文件名
+	assets.init_assets(app,use_manifest=not configs.debug)
+	return app
 
-	srv = yield from loop.create_server(app.make_handler(),'127.0.0.1',9000)
-	logging.info('server start at http://127.0.0.1:9000...')
+#单进程模式，多进程请使用prefork.py
+@asyncio.coroutine
+def init(loop):
+	app = yield from create_app(loop)
+	srv = yield from loop.create_server(app.make_handler(),configs.server.host,configs.server.port)
+	logging.info('server start at http://%s:%s...'%(configs.server.host,configs.server.port))
 	return srv
 
 #asyncio的编程模块实际就是一个消息循环。我们asyncio模块中直接获取一个eventloop(时间循环)的引用
 #然后把需要执行的协程扔到eventloop中执行，就实现了异步IO
 #第一步是获取eventloop
 
-#get_event_loop() => 获取当前脚本下时间循环，返回一个event loop对象(这个对象的类型是"asyncio.windows_event._WindowsSelectorEvent")
-loop = asyncio.get_event_loop()
-#之后是执行coroutine
-loop.run_until_complete(init(loop))
-#无限循环运行知道stop()
-loop.run_forever()
+#只有直接运行app.py时才启动服务器，这样其他脚本(如compile_templates.py)可以导入本模块
+if __name__ == '__main__':
+	#get_event_loop() => 获取当前脚本下时间循环，返回一个event loop对象(这个对象的类型是"asyncio.windows_event._WindowsSelectorEvent")
+	loop = asyncio.get_event_loop()
+	#之后是执行coroutine
+	loop.run_until_complete(init(loop))
+	#无限循环运行知道stop()
+	loop.run_forever()
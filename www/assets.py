@@ -0,0 +1,95 @@
+#静态文件指纹
+#构建时(python assets.py)为static/css、static/js、static/fonts下的文件生成带内容哈希的副本，如css/uikit.min.css => css/uikit.min.3f2a9c81d0.css
+#并把 原文件名 => 带哈希的文件名 写入static/manifest.json
+#模板中用{{ static_url('css/uikit.min.css') }}或{{ '/static/css/uikit.min.css'|static }}引用静态文件，有manifest时会被替换为带哈希的url
+#带哈希的url内容永远不会变，可以让浏览器永久缓存：Cache-Control: public, max-age=31536000, immutable
+#旧的带哈希文件不会被删除，已经缓存了旧页面的浏览器仍然能取到它们
+
+import logging
+import os,re,sys,json,hashlib,shutil
+
+STATIC_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)),'static')
+STATIC_PREFIX = '/static/'
+MANIFEST_NAME = 'manifest.json'
+#需要生成指纹的目录，fonts要在css之前处理，因为css中引用了fonts
+ASSET_DIRS = ('fonts','js','css')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+#已经带有哈希的文件名，如uikit.min.3f2a9c81d0.css
+_RE_HASHED = re.compile(r'\.[0-9a-f]{10}\.[^./]+$')
+#css中的url(...)引用，可能带引号和?#iefix之类的后缀
+_RE_CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")?#]+)([?#][^'")]*)?\1\s*\)''')
+
+def hashed_name(rel,data):
+	base,ext = os.path.splitext(rel)
+	return '%s.%s%s'%(base,hashlib.md5(data).hexdigest()[:10],ext)
+
+#把css中对其他静态文件的相对引用替换为带哈希的文件名
+def rewrite_css(rel,text,manifest):
+	css_dir = os.path.dirname(rel)
+	def sub(m):
+		quote,url,suffix = m.group(1),m.group(2),m.group(3) or ''
+		if '://' in url or url.startswith(('/','data:')):
+			return m.group(0)
+		target = os.path.normpath(os.path.join(css_dir,url)).replace(os.sep,'/')
+		if target not in manifest:
+			return m.group(0)
+		return 'url(%s%s%s%s)'%(quote,os.path.relpath(manifest[target],css_dir).replace(os.sep,'/'),suffix,quote)
+	return _RE_CSS_URL.sub(sub,text)
+
+#生成带哈希的副本和manifest，返回manifest
+def build_manifest(root=STATIC_ROOT):
+	manifest = {}
+	for d in ASSET_DIRS:
+		for dirpath,dirnames,filenames in os.walk(os.path.join(root,d)):
+			dirnames.sort()
+			for name in sorted(filenames):
+				if _RE_HASHED.search(name) or name.endswith(('.gz','.br','.tmp')):
+					continue
+				path = os.path.join(dirpath,name)
+				rel = os.path.relpath(path,root).replace(os.sep,'/')
+				with open(path,'rb') as f:
+					data = f.read()
+				if name.endswith('.css'):
+					data = rewrite_css(rel,data.decode('utf-8'),manifest).encode('utf-8')
+				manifest[rel] = hashed_name(rel,data)
+				target = os.path.join(root,manifest[rel])
+				if not os.path.exists(target):
+					with open(target,'wb') as f:
+						f.write(data)
+					#保留原文件的修改时间，precompress_static.py据此判断是否需要重新压缩
+					shutil.copystat(path,target)
+					logging.info('%s => %s'%(rel,manifest[rel]))
+	with open(os.path.join(root,MANIFEST_NAME),'w') as f:
+		json.dump(manifest,f,indent=1,sort_keys=True)
+	return manifest
+
+#运行时使用的manifest，为空时static_url直接返回原始url
+_manifest = {}
+_immutable_paths = set()
+
+def init_assets(app,use_manifest=True,root=STATIC_ROOT):
+	global _manifest,_immutable_paths
+	_manifest = {}
+	path = os.path.join(root,MANIFEST_NAME)
+	if use_manifest and os.path.exists(path):
+		with open(path) as f:
+			_manifest = json.load(f)
+		logging.info('load asset manifest: %s files'%len(_manifest))
+	_immutable_paths = set(STATIC_PREFIX + v for v in _manifest.values())
+	app.on_response_prepare.append(cache_headers)
+
+#模板全局函数：static_url('css/uikit.min.css') => /static/css/uikit.min.3f2a9c81d0.css
+def static_url(path):
+	rel = path[len(STATIC_PREFIX):] if path.startswith(STATIC_PREFIX) else path.lstrip('/')
+	return STATIC_PREFIX + _manifest.get(rel,rel)
+
+#给带哈希的静态文件加上永久缓存的header
+async def cache_headers(request,response):
+	if request.path in _immutable_paths:
+		response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	root = sys.argv[1] if len(sys.argv) > 1 else STATIC_ROOT
+	logging.info('%s assets in manifest'%len(build_manifest(root)))
@@ -0,0 +1,141 @@
+#进程内缓存，所有请求共享
+#LRUCache是带容量上限和过期时间的LRU缓存：超过maxsize时淘汰最久没有被访问的条目，过期的条目在访问时被清除
+
+import time,json,socket,logging
+#OrderedDict会记住插入顺序，move_to_end/popitem可以在O(1)时间内维护LRU顺序
+from collections import OrderedDict
+
+#==========================================多进程之间的缓存作废=======================================================
+#prefork.py启动多个worker时，每个worker都有自己的一份缓存(包括orm.count_cache)，写操作只作废处理它的那个worker中的条目
+#每个worker和supervisor之间有一对unix数据报socket(channel)：本进程作废条目后用broadcast()把消息发给supervisor，
+#supervisor再转发给其他worker，它们按消息的kind调用subscribe()登记的函数，在自己的缓存上做同样的作废
+#socket缓冲区满时消息会被丢弃，收不到的worker中的旧条目要等到过期才消失，所以各个缓存的ttl不能太长
+#单进程模式下没有channel，broadcast()什么也不做
+
+_channel = None
+_subscribers = {}   #kind => function(*args)，只作废本进程中的条目，不能再广播
+
+def subscribe(kind,fn):
+	_subscribers[kind] = fn
+
+#args必须能序列化为JSON
+def broadcast(kind,*args):
+	if _channel is None:
+		return
+	try:
+		_channel.send(json.dumps([kind] + list(args)).encode('utf-8'))
+	except OSError as e:
+		logging.warning('cache invalidation %s%s not broadcast: %s'%(kind,args,e))
+
+#worker启动时由prefork.py调用，fd为supervisor传过来的channel
+def attach(fd,loop):
+	global _channel
+	_channel = socket.socket(fileno=fd)
+	_channel.setblocking(False)
+	loop.add_reader(fd,_receive)
+
+def _receive():
+	while True:
+		try:
+			data = _channel.recv(65536)
+		except BlockingIOError:
+			return
+		if not data:
+			return
+		try:
+			kind,*args = json.loads(data.decode('utf-8'))
+			_subscribers[kind](*args)
+		except Exception as e:
+			logging.exception(e)
+
+class LRUCache(object):
+	def __init__(self,maxsize=1024,ttl=None):
+		'''
+		maxsize - 最多缓存的条目数
+		ttl - 默认的有效期(秒)，None表示永不过期
+		'''
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self._data = OrderedDict()   #key => (value,过期时间)
+
+	def get(self,key,default=None):
+		entry = self._data.get(key)
+		if entry is None:
+			return default
+		value,expires = entry
+		if expires is not None and expires < time.time():
+			del self._data[key]
+			return default
+		self._data.move_to_end(key)   #最近被访问的放到最后
+		return value
+
+	#ttl不传时使用默认的有效期
+	def set(self,key,value,ttl=None):
+		if ttl is None:
+			ttl = self.ttl
+		self._data[key] = (value,None if ttl is None else time.time() + ttl)
+		self._data.move_to_end(key)
+		while len(self._data) > self.maxsize:
+			self._data.popitem(last=False)   #淘汰最久没有被访问的条目
+
+	def delete(self,key):
+		self._data.pop(key,None)
+
+	#删除所有满足predicate(key,value)的条目，需要遍历整个缓存，只适合在写操作这类低频场景使用
+	def delete_if(self,predicate):
+		for key,(value,expires) in list(self._data.items()):
+			if predicate(key,value):
+				del self._data[key]
+
+	def clear(self):
+		self._data.clear()
+
+	def __len__(self):
+		return len(self._data)
+
+#已验证的session：cookie字符串 => User，由handlers.cookie2user填充
+#User更新或删除时(见models.User)以及用户登出时作废，作废会广播给其他worker
+class SessionCache(LRUCache):
+	#用户登出时作废这个cookie
+	def forget(self,cookie):
+		if cookie:
+			self.delete(cookie)
+			broadcast('session',cookie)
+
+	#用户被修改或删除时作废该用户所有的session
+	def forget_user(self,user_id):
+		self.discard_user(user_id)
+		broadcast('session_user',user_id)
+
+	def discard_user(self,user_id):
+		self.delete_if(lambda k,u: u.id == user_id)
+
+session_cache = SessionCache(maxsize=10000,ttl=600)
+subscribe('session',session_cache.delete)
+subscribe('session_user',session_cache.discard_user)
+
+#整页缓存：只缓存匿名用户的GET请求，key为path+query
+#每个条目带有若干标签(如'blogs'表示首页列表，'blog:<id>'表示某篇博客的详情页)，写操作通过标签精确作废相关页面
+class PageCache(LRUCache):
+	def __init__(self,maxsize=1000,ttl=60):
+		super(PageCache,self).__init__(maxsize,ttl)
+		#每次作废都加一，渲染开始和结束时的generation不同说明期间有写操作，渲染结果可能是旧的，不能缓存
+		self.generation = 0
+
+	#value为(body,content_type,tags,etag)，etag为handler给出的ETag，没有时为None
+	def put(self,key,body,content_type,tags,generation,etag=None):
+		if generation == self.generation:
+			self.set(key,(body,content_type,frozenset(tags),etag))
+
+	#作废带有任一标签的页面，并广播给其他worker
+	def invalidate(self,*tags):
+		self.discard(*tags)
+		broadcast('page',*tags)
+
+	def discard(self,*tags):
+		self.generation += 1
+		tags = set(tags)
+		self.delete_if(lambda k,v: not tags.isdisjoint(v[2]))
+
+page_cache = PageCache()
+subscribe('page',page_cache.discard)
@@ -0,0 +1,20 @@
+#预编译templates目录下的全部模板，把字节码写入jinja2的字节码缓存目录
+#部署后、启动app.py之前运行一次，所有worker冷启动时都直接读取缓存的字节码，不用再编译模板
+#用法：python compile_templates.py [缓存目录]，缓存目录默认为configs.templates.bytecode_cache_dir
+
+import logging; logging.basicConfig(level=logging.INFO)
+import sys
+
+from config import configs
+from app import create_jinja2_env,load_templates,TEMPLATE_FILTERS,TEMPLATE_GLOBALS
+
+def main(argv):
+	cache_dir = argv[1] if len(argv) > 1 else configs.templates.bytecode_cache_dir
+	env = create_jinja2_env(filters=TEMPLATE_FILTERS,globals=TEMPLATE_GLOBALS,auto_reload=False,bytecode_cache_dir=cache_dir)
+	templates = load_templates(env)
+	for name in sorted(templates):
+		logging.info('compiled template: %s'%name)
+	logging.info('%s templates compiled into %s'%(len(templates),cache_dir))
+
+if __name__ == '__main__':
+	main(sys.argv)
@@ -13,7 +13,29 @@ configs = {
 		'password':'www-data',
 		'db':'awesome'
 	},
+	'sql':{
+		'sample_rate':0.01,     #普通SQL写入日志的比例
+		'slow_ms':100,          #超过这个耗时(毫秒)的SQL记为慢查询，并捕获EXPLAIN执行计划
+		'explain':True,
+		'slow_log_size':100     #内存中最多保留的慢查询条数
+	},
+	'server':{
+		'host':'127.0.0.1',
+		'port':9000,
+		'workers':None,         #prefork.py的worker进程数，None表示CPU核数
+		'db_pool_budget':40,    #所有worker共用的数据库连接总数，平均分给每个worker
+		'grace':10              #worker退出前等待正在处理的请求完成的最长时间(秒)
+	},
 	'session':{
 		'secret':'Awesome'
+	},
+	'templates':{
+		'bytecode_cache_dir':'/tmp/awesome-jinja2'   #非调试模式下jinja2字节码缓存的目录
+	},
+	'render':{
+		'workers':None,        #渲染进程数，None表示CPU核数
+		'inline_below':8192,   #短于这个长度的文本直接在事件循环中渲染
+		'timeout':10,          #渲染超时(秒)
+		'max_pending':64       #进程池中最多排队的渲染任务数
 	}
 }
\ No newline at end of file
@@ -1,8 +1,10 @@
 
 
-import asyncio,os,inspect,logging
+import asyncio,os,inspect,logging,hashlib
 #高阶函数模块，提供常用的高阶函数，如wraps
 import functools
+#用于生成和解析http日期格式，如Last-Modified
+from email.utils import formatdate,parsedate_to_datetime
 
 from urllib import parse
 from aiohttp import web
@@ -42,6 +44,35 @@ def post(path):
 		return wrapper
 	return decorator
 
+#根据若干部分计算强ETag，各部分可以是bytes或任何能转成字符串的对象
+def make_etag(*parts):
+	sha1 = hashlib.sha1()
+	for part in parts:
+		sha1.update(part if isinstance(part,bytes) else str(part).encode('utf-8'))
+		sha1.update(b'\0')
+	return '"%s"' % sha1.hexdigest()
+
+#把时间戳转为http日期格式，用作Last-Modified
+def http_date(t):
+	return formatdate(t,usegmt=True)
+
+#判断条件GET请求的缓存是否仍然有效，有效时应返回304
+#If-None-Match优先；只有没带If-None-Match时才看If-Modified-Since
+def not_modified(request,etag,last_modified=None):
+	inm = request.headers.get('If-None-Match')
+	if inm is not None:
+		if etag is None:
+			return False
+		tags = [t.strip() for t in inm.split(',')]
+		return '*' in tags or etag in tags or ('W/' + etag) in tags
+	ims = request.headers.get('If-Modified-Since')
+	if ims and last_modified:
+		try:
+			return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(ims)
+		except (TypeError,ValueError):
+			return False
+	return False
+
 #这个函数的参数fn本身就是个函数，下面五个函数是针对fn函数的参数做一些处理判断
 
 #这个函数将得到fn函数中没有默认值的关键字参数的元组
@@ -91,6 +122,71 @@ def has_request_arg(fn):
 			raise ValueError('request parameter must be the last named parameter in function:%s%s'%(fn.__name__,str(sig)))
 	return found
 
+#在注册路由时根据fn的签名生成专用的参数绑定函数binder，每个请求只做这个签名需要的工作
+#binder(request)返回传给fn的参数dict；请求不合法时返回一个web.Response(如HTTPBadRequest)
+def compile_binder(fn):
+	has_request = has_request_arg(fn)
+	has_var_kw = has_var_kw_arg(fn)
+	named = get_named_kw_args(fn)
+	required = get_required_kw_args(fn)
+
+	#签名中没有关键字参数：不用解析body和查询字符串，只需要路由路径中的参数(如/blog/{id}里的id)
+	if not has_var_kw and not named:
+		if has_request:
+			async def bind(request):
+				kw = dict(request.match_info)
+				kw['request'] = request
+				return kw
+		else:
+			async def bind(request):
+				return dict(request.match_info)
+		return bind
+
+	#没有可变关键字参数(**kw)时，只保留签名中的关键字参数
+	select = None if has_var_kw else named
+
+	async def bind(request):
+		kw = None
+		#http method为post的处理
+		if request.method == 'POST':
+			#content_type是request提交的消息主体类型，没有就返回丢失消息主体类型
+			if not request.content_type:
+				return web.HTTPBadRequest(text='Missing Content-type.')
+			ct = request.content_type.lower()
+			#application/json表示消息主体是序列化后的json字符串
+			if ct.startswith('application/json'):
+				kw = await request.json()
+				if not isinstance(kw,dict):
+					return web.HTTPBadRequest(text='JSON body must be object.')
+			#以下两种content type都表示消息主体是表单
+			elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+				kw = dict(**(await request.post()))
+			else:
+				return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
+		#http method 为get的处理，解析查询字符串，如'ie=UTF-8&wd=Python'解析为{'ie':'UTF-8','wd':'Python'}
+		elif request.method == 'GET':
+			qs = request.query_string
+			if qs:
+				kw = dict((k,v[0]) for k,v in parse.parse_qs(qs,True).items())
+		if kw is None:
+			kw = dict(request.match_info)
+		else:
+			if select is not None:
+				kw = dict((name,kw[name]) for name in select if name in kw)
+			#再把路由路径中的参数放入kw中，重名时发出警告
+			for k,v in request.match_info.items():
+				if k in kw:
+					logging.warning('Duplicate arg name in named arg and kw args:%s'%k)
+				kw[k] = v
+		if has_request:
+			kw['request'] = request
+		#kw必须包含全部没有默认值的关键字参数，如果发现遗漏则说明有参数没传入，报错
+		for name in required:
+			if not name in kw:
+				return web.HTTPBadRequest(text='Missing argument:%s'%name)
+		return kw
+	return bind
+
 #定义RequestHandlers类，封装url处理函数
 #RequestHandler的目的是从url函数中分析需要提取的参数，从request中获取必要的参数
 #调用url参数，将结果换位web.response
@@ -100,99 +196,22 @@ class RequestHandler(object):
 	def __init__(self,app,fn):
 		self.app = app
 		self._func = fn
-		#下面的属性是对传入的fn的参数的一些判断
-		self._has_request_arg = has_request_arg(fn)
-		self._has_var_kw_arg = has_var_kw_arg(fn)
-		self._has_named_kw_args = has_named_kw_args(fn)
-		self._name_kw_args = get_named_kw_args(fn)
-		self._required_kw_args = get_required_kw_args(fn)
+		#路由的方法和路径模式，app.metrics_factory用它们给请求的指标打标签
+		self.__method__ = getattr(fn,'__method__',None)
+		self.__route__ = getattr(fn,'__route__',None)
+		#参数的提取方式在注册路由时就确定下来，见compile_binder
+		self._bind = compile_binder(fn)
 
 	#定义__call__参数后，其实例可以被视为函数
 	#此处参数为request
 	async def __call__(self,request):
-		kw = None    #假设不存在关键字参数
-		if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-			#http method为post的处理
-			if request.method == 'POST':
-				#content_type是request提交的消息主体类型，没有就返回丢失消息主体类型
-				if not request.content_type:
-					return web.HTTPBadRequest('Missing Content-type.')
-				#把request.content_type转化为小写
-				ct = request.content_type.lower()
-				#application/json表示消息主体是序列化后的json字符串
-				if ct.startswith('application/json'):
-					params = await request.json()  #用json方法读取信息
-					if not isinstance(params,dict):  #如果读取出来的信息类型不是dict
-						return web.HTTPBadRequest('JSON body must be object.')
-					kw = params  #把读取出来的dict复制给kw
-				#以下两种content type都表示消息主体是表单
-				elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-					#request.post方法从request body读取POST参数，即表单信息，并包装成字典赋值给kw变量
-					params = await request.post()
-					kw = dict(**params)
-				else: #post的消息主体既不是json对象，又不是浏览器表单，那就只能返回不支持该消息主体类型
-					return web.HTTPBadRequest('Unsupported Content-Type: %s' %request.content_type)
-
-			#http method 为get的处理
-			if request.method == 'GET':
-				#request.query_string表示url中的查询字符串
-				#比如我百度Python,得到网址为https://www.baidu.com/s?ie=UTF-8&wd=Python
-				#其中‘ie=UTF-8&wd=Python’就是查询字符串
-				qs = request.query_string 
-				if qs:
-					kw = dict()
-					#parse.parse_qs(qs,keep_blank_values=False,string_parsing=False)函数的作用是解析一个给定的字符串
-					#keep_blank_values默认为False,表示是否忽略空白值，True不忽略，False忽略
-					#string_parsing如果是True，遇到错误时会抛出ValueError错误，如果是False会忽略错误
-					#这个函数将返回一个字典，其中key是等号之前的字符串，value是等号之后的字符串但会是列表
-					#比如上面的例子就返回{'ie':['UTF-8'],'wd':['Python']}
-					for k,v in parse.parse_qs(qs,True).items():
-						kw[k] = v[0]
-
-		#如果经过以上处理kw是None，即上面if语句块没有被执行
-		#则获取请求的abstract math info(抽象数学信息),并以字典形式存入kw
-		#match_info主要是保存像@get('/blog/{id}')里面的id，就是路由路径里的参数
-		if kw is None:
-			kw = dict(**request.match_info)
-		else:
-			#如果经过以上处理了，kw不为空了，而且没有可变的关键字参数，但是有关键字参数
-			if not self._has_var_kw_arg and self._name_kw_args:
-				#下面五行代码的意思是将kw中的key为关键字参数的项提取出来保存为新的kw
-				#即剔除kw中key不是fn的关键字参数的项
-				copy = dict()
-				for name in self._name_kw_args:
-					if name in kw:
-						copy[name] = kw[name]
-				kw = copy
-			#遍历request.match_info(abstract math info),再把abstract math info的值放入kw中
-			#若其key既存在于absract math info有存在于kw中，发出重复参数警告
-			for k,v in request.match_info.items():
-				if k in kw:
-					logging.warning('Duplicate arg name in named arg and kw args:%s'%k)
-				kw[k] = v
-
-		#如果fn的参数有request，则再给kw中加上request的key和值
-		if self._has_request_arg:
-			kw['request'] = request
-
-		#如果fn的参数有，没有默认值的关键字参数
-		#这个if语句块主要是为了检查一下kw
-		if self._required_kw_args:
-			for name in self._required_kw_args:
-				#kw必须包含全部没有默认值的关键字参数，如果发现遗漏则说明有参数没传入，报错
-				if not name in kw:
-					return web.HTTPBadRequest(text='Missing argument:%s'%name)
-		#以上过程即为从request中获得必要的参数，并组成kw
-
-		#以下调用handler处理，并返回response
-		logging.info('call with args: %s'%str(kw))
+		kw = await self._bind(request)
+		if not isinstance(kw,dict):   #参数不合法，binder返回的是错误响应
+			return kw
+		#只在debug级别输出，并且由logging在真正需要输出时才格式化
+		logging.debug('call with args: %s',kw)
 		try:
-			print("Aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa")
-			print(self._func)
-			print(self._func.__name__)
-			r = await self._func(**kw)   #执行handler模块里的函数
-			print(r)
-			return r
+			return await self._func(**kw)   #执行handler模块里的函数
 		except APIError as e:
 			return dict(error=e.error,data=e.data,message=e.message)
 
@@ -3,20 +3,26 @@
 
 import re,time,json,logging,hashlib,base64,asyncio
 
-#markdown2模块是一个支持markdown文本输入的模块,是Trent Mick写的开源模块
-import markdown2
+import renderer
+import metrics
+import orm
 
 from aiohttp import web
 
-from coroweb import get,post
-from apis import APIValueError,APIResourceNotFoundError,APIError,APIPermissionError,Page
+from coroweb import get,post,make_etag
+from apis import APIValueError,APIResourceNotFoundError,APIError,APIPermissionError,Page,CursorPage
 
 from models import User,Comment,Blog,next_id
 from config import configs
+from cache import session_cache,page_cache
 
 COOKIE_NAME = 'awesession'  #cookie名，用于设置cookie
 _COOKIE_KEY = configs.session.secret    #cookie密钥，作为cookie的原始字符串的一部分
 
+#博客列表(首页和/api/blogs)只显示名称、摘要、作者和创建时间，不读取正文
+#列表都是只读的，查询时同时使用compact=True，得到紧凑的行对象(见orm.Row)
+LIST_DEFER = ('content','html_content')
+
 #这个函数在api_create_blog()中被调用
 #用来验证用户身份,如果没有用户或用户没有管理员属性则报错
 def check_admin(request):
@@ -66,6 +72,10 @@ def cookie2user(cookie_str):
 	'''
 	if not cookie_str:
 		return None 
+	#先查session缓存，命中时不用再查数据库和计算sha1
+	user = session_cache.get(cookie_str)
+	if user is not None:
+		return User(**user)   #返回副本，避免请求处理过程中修改到缓存里的对象
 	try:
 		#解密是加密的逆向过程,因此,先通过"-"拆分cookie,得到用户id,失效时间,以及加密字符串
 		L = cookie_str.split('-') #返回一个str的list
@@ -84,6 +94,8 @@ def cookie2user(cookie_str):
 			logging.info('invalid sha1')
 			return None
 		user.passwd = '******'
+		#缓存的有效期不能超过cookie本身的失效时间
+		session_cache.set(cookie_str,User(**user),ttl=min(session_cache.ttl,int(expires) - time.time()))
 		#验证cookie就是为了验证当前用户是否在登录状态,从而使用户不必在进行登录
 		#因此,返回用户信息即可
 		return user
@@ -103,7 +115,7 @@ def register():
 #首页
 @get('/')
 @asyncio.coroutine
-def index(*,page='1'):
+def index(*,page=None,cursor=None):
 	'''
 	summary = 'Lorem ipsum dolor sit amet,consectetur adipisicing elit,sed do eiusmod tempor incididint ut labore et dolore magna aliqua.'
 	blogs = [
@@ -117,17 +129,29 @@ def index(*,page='1'):
 		'blogs':blogs
 	}
 	'''
+	#默认使用游标分页，只有显式带了page参数(旧链接)才走offset分页
+	if page is None:
+		page = CursorPage(cursor)
+		blogs = yield from Blog.findAll(orderBy='created_at desc,id desc',after=page.after,before=page.before,limit=page.limit,defer=LIST_DEFER,compact=True)
+		blogs = page.paginate(blogs)
+		return {
+			'__template__':'blogs.html',
+			'__cache_tags__':['blogs'],   #匿名访问的结果可以被整页缓存，博客增删改时作废
+			'page':page,
+			'blogs':blogs
+		}
 	page_index = get_page_index(page)
-	num = yield from Blog.findNumber('count(id)')
+	num = yield from Blog.findCount()
 	page = Page(num,page_index)
 	if num == 0:
 		blogs = []
 	else:
-		blogs = yield from Blog.findAll(orderBy="created_at desc",limit=(page.offset,page.limit))
+		blogs = yield from Blog.findAll(orderBy="created_at desc",limit=(page.offset,page.limit),defer=LIST_DEFER,compact=True)
 	#返回一个模板，指示使用何种模板，模板的内容
 	#app.py的response_factory将会对handler.py的返回值进行分类处理
 	return {
 		'__template__':'blogs.html',
+		'__cache_tags__':['blogs'],
 		'page':page,
 		'blogs':blogs
 	}
@@ -160,10 +184,28 @@ def get_blog(id,request):
 	#将每条评论转化为html格式
 	for c in comments:
 		c.html_content = text2html(c.content)
-	#blog也是markdown格式,将其转化为html格式
-	blog.html_content = markdown2.markdown(blog.content)
+	#blog的html在写入时已经渲染好了，只有旧数据或渲染器版本变化时才在这里重新渲染并回写
+	if blog.needs_render():
+		stale_version = blog.render_version
+		try:
+			blog.render((yield from renderer.markdown(blog.content)))
+		except (renderer.RenderBusyError,renderer.RenderTimeoutError) as e:
+			#渲染进程池忙或超时时先用已存的旧html显示，下次浏览时再重新渲染；从没渲染过的旧数据只能在事件循环中直接渲染
+			logging.warning('backfill render of blog %s failed: %s'%(blog.id,e))
+			if not blog.html_content:
+				blog.render()
+		if not blog.needs_render():
+			try:
+				yield from blog.save_render(stale_version)
+			except Exception as e:
+				logging.exception(e)   #回写失败不影响本次浏览
+	user = request.__user__
 	return {
 		'__template__':'blog.html',
+		#页面的版本：博客内容、评论列表以及当前用户，都没变时直接返回304，不用渲染模板
+		'__etag__':make_etag(blog.id,blog.name,blog.summary,blog.content,blog.render_version,','.join(c.id for c in comments),user.id if user else ''),
+		'__stream__':True,   #评论可能很多，边渲染边发送
+		'__cache_tags__':['blog:%s'%id],   #该博客或它的评论变化时作废
 		'blog':blog,
 		'__user__':request.__user__,
 		'comments':comments
@@ -251,6 +293,8 @@ def singout(request):
 	referer = request.headers.get('Referer')
 	#如果referer为None，则说明无前一个网址，可能用户新打开了一个标签页，则登录后转到首页
 	r = web.HTTPFound(referer or '/')
+	#作废该cookie对应的session缓存
+	session_cache.forget(request.cookies.get(COOKIE_NAME))
 	#通过设置cookie的最大存活时间来删除cookie，从而是登录状态消失
 	r.set_cookie(COOKIE_NAME,'-deleted-',max_age=0,httponly=True)
 	logging.info('user singed out.')
@@ -261,7 +305,7 @@ def singout(request):
 @asyncio.coroutine
 def api_get_users(*,page='1'):
 	page_index = get_page_index(page)
-	num = yield from User.findNumber('count(id)')  #num为用户总数
+	num = yield from User.findCount()  #num为用户总数
 	p = Page(num,page_index)  #创建Page对象，保存页面信息
 	if num == 0:
 		return dict(page=p,users=())
@@ -337,7 +381,9 @@ def api_create_blog(request,*,name,summary,content):
 		raise APIValueError('content','content cannot be empty.')
 	#创建博客对象
 	blog = Blog(user_id=request.__user__.id,user_name=request.__user__.name,user_image=request.__user__.image,name=name.strip(),summary=summary.strip(),content=content.strip())
+	blog.render((yield from renderer.markdown(blog.content)))   #写入时预先渲染html
 	yield from blog.save()   #储存博客到数据库中
+	page_cache.invalidate('blogs')   #首页列表变化了
 	return blog   #返回博客信息
 
 #实现获取单条博客信息功能的API
@@ -350,29 +396,39 @@ def api_get_blog(*,id):
 #博客页面管理API
 @get('/api/blogs')
 @asyncio.coroutine
-def api_blogs(*,page='1'):
+def api_blogs(*,page='1',cursor=None):
+	#带cursor参数(可以为空字符串，表示第一页)时使用游标分页，不再统计总数
+	if cursor is not None:
+		p = CursorPage(cursor)
+		blogs = yield from Blog.findAll(orderBy='created_at desc,id desc',after=p.after,before=p.before,limit=p.limit,defer=LIST_DEFER,compact=True)
+		return dict(page=p,blogs=p.paginate(blogs))
 	page_index = get_page_index(page)
-	num = yield from Blog.findNumber('count(id)')  #nun为博客总数
+	num = yield from Blog.findCount()  #nun为博客总数
 	p = Page(num,page_index)   #创建Page对象(Page对象在apis.py中定义)
 	if num == 0:
 		return dict(page=p,blogs=()) #若博客数为0，返回字典，将被app.py的response中间件再处理
 	#博客总数不为0,则从数据库中抓取博客
 	#limit强制select语句返回指定的记录数,前一个参数为偏移量,后一个参数为记录的最大数目
-	blogs = yield from Blog.findAll(orderBy='created_at desc',limit=(p.offset,p.limit))
+	blogs = yield from Blog.findAll(orderBy='created_at desc',limit=(p.offset,p.limit),defer=LIST_DEFER,compact=True)
 	return dict(page=p,blogs=blogs)     #返回字典,以供response中间件处理
 
 #获取评论API
 @get('/api/comments')
 @asyncio.coroutine
-def api_comments(*,page='1'):
+def api_comments(*,page='1',cursor=None):
+	#带cursor参数(可以为空字符串，表示第一页)时使用游标分页，不再统计总数
+	if cursor is not None:
+		p = CursorPage(cursor)
+		comments = yield from Comment.findAll(orderBy='created_at desc,id desc',after=p.after,before=p.before,limit=p.limit,compact=True)
+		return dict(page=p,comments=p.paginate(comments))
 	page_index = get_page_index(page)
-	num = yield from Comment.findNumber('count(id)')  #num为评论总数
+	num = yield from Comment.findCount()  #num为评论总数
 	p = Page(num,page_index)  #创建Page对象，保存页面信息
 	if num == 0:
 		return dict(page=p,comments=())   #若评论数为零，返回字典,将会被app.py的response中间件再处理
 	#博客总数不为零，则从数据库中抓取博客
 	#limit强制select语句返回指定的记录数，前一个参数为偏移量，后一个参数为记录的最大数目
-	comments = yield from Comment.findAll(orderBy='created_at desc',limit=(p.offset,p.limit))
+	comments = yield from Comment.findAll(orderBy='created_at desc',limit=(p.offset,p.limit),compact=True)
 	return dict(page=p,comments=comments)
 
 #创建评论API
@@ -393,6 +449,7 @@ def api_create_comment(id,request,*,content):
 	#创建评论对象
 	comment = Comment(blog_id=blog.id,user_id=user.id,user_name=user.name,user_image=user.image,content=content.strip())
 	yield from comment.save()   #储存评论到数据库中
+	page_cache.invalidate('blog:%s'%blog.id)
 	return comment  #返回评论
 
 #删除评论API
@@ -404,6 +461,7 @@ def api_delete_comments(id,request):
 	if c is None:
 		raise APIResourceNotFoundError('comment')
 	yield from c.remove()   #删除评论
+	page_cache.invalidate('blog:%s'%c.blog_id)
 	return dict(id=id)    #返回删除评论的id
 
 #修改博客API
@@ -421,8 +479,10 @@ def api_update_blog(id,request,*,name,summary,content):
 		raise APIValueError('content','content cannot be empty.')
 	blog.name = name.strip()
 	blog.summary = summary.strip()
-	blog.connent = content.strip()
+	blog.content = content.strip()
+	blog.render((yield from renderer.markdown(blog.content)))   #正文变化后重新渲染html
 	yield from blog.update()   #更新博客
+	page_cache.invalidate('blogs','blog:%s'%id)
 	return blog   #返回博客信息
 
 #删除博客API
@@ -431,5 +491,20 @@ def api_update_blog(id,request,*,name,summary,content):
 def api_delete_blog(request,*,id):
 	check_admin(request)
 	blog = yield from Blog.find(id)
-	yield from blog.remove
-	return dict(id=id)
\ No newline at end of file
+	if blog is None:
+		raise APIResourceNotFoundError('Blog')
+	yield from blog.remove()
+	page_cache.invalidate('blogs','blog:%s'%id)
+	return dict(id=id)
+
+#运行指标，Prometheus文本格式，只有管理员可以访问
+@get('/metrics')
+def api_metrics(request):
+	check_admin(request)
+	return web.Response(body=metrics.render().encode('utf-8'),headers={'Content-Type':'text/plain; version=0.0.4; charset=utf-8'})
+
+#最近的慢查询及其执行计划，只有管理员可以访问
+@get('/api/slow_queries')
+def api_slow_queries(request):
+	check_admin(request)
+	return dict(queries=orm.query_log.entries())
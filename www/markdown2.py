@@ -95,10 +95,15 @@ from pprint import pprint, pformat
 import re
 import logging
 try:
-    from hashlib import md5
+    from hashlib import md5, sha1
 except ImportError:
     from md5 import md5
+    from sha import new as sha1
 import optparse
+import json
+import mmap
+import threading
+from collections import OrderedDict
 from random import random, randint
 import codecs
 
@@ -139,13 +144,19 @@ log = logging.getLogger("markdown")
 DEFAULT_TAB_WIDTH = 4
 
 
-SECRET_SALT = bytes(randint(0, 1000000))
+# Note: `bytes(n)` on Python 3 is n zero bytes, which made every
+# `_hash_text()` call digest up to a megabyte of salt. Use the digits.
+SECRET_SALT = str(randint(0, 1000000)).encode("ascii")
 def _hash_text(s):
     return 'md5-' + md5(SECRET_SALT + s.encode("utf-8")).hexdigest()
 
 # Table of hash values for escaped characters:
 g_escape_table = dict([(ch, _hash_text(ch))
     for ch in '\\`*_{}[]()>#+-.!'])
+# ... and the same with quotes, for the "smarty-pants" extra.
+g_smarty_escape_table = dict(g_escape_table)
+g_smarty_escape_table['"'] = _hash_text('"')
+g_smarty_escape_table["'"] = _hash_text("'")
 
 
 
@@ -161,22 +172,28 @@ class MarkdownError(Exception):
 def markdown_path(path, encoding="utf-8",
                   html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
                   safe_mode=None, extras=None, link_patterns=None,
-                  use_file_vars=False):
+                  use_file_vars=False, cache=None):
     fp = codecs.open(path, 'r', encoding)
     text = fp.read()
     fp.close()
     return Markdown(html4tags=html4tags, tab_width=tab_width,
                     safe_mode=safe_mode, extras=extras,
                     link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+                    use_file_vars=use_file_vars, cache=cache).convert(text)
 
 def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
              safe_mode=None, extras=None, link_patterns=None,
-             use_file_vars=False):
-    return Markdown(html4tags=html4tags, tab_width=tab_width,
-                    safe_mode=safe_mode, extras=extras,
-                    link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+             use_file_vars=False, cache=None):
+    if link_patterns is not None:
+        # Not hashable, so can't pick a pool by it.
+        return Markdown(html4tags=html4tags, tab_width=tab_width,
+                        safe_mode=safe_mode, extras=extras,
+                        link_patterns=link_patterns,
+                        use_file_vars=use_file_vars, cache=cache).convert(text)
+    # Reuse a pooled instance; extras are applied per call.
+    return _get_pool(html4tags=html4tags, tab_width=tab_width,
+                     safe_mode=safe_mode, use_file_vars=use_file_vars,
+                     cache=cache).convert(text, extras=extras)
 
 class Markdown(object):
     # The dict of "extras" to enable in processing -- a mapping of
@@ -199,8 +216,12 @@ class Markdown(object):
 
     _ws_only_line_re = re.compile(r"^[ \t]+$", re.M)
 
+    # An optional `RenderCache` consulted by `convert()`.
+    cache = None
+
     def __init__(self, html4tags=False, tab_width=4, safe_mode=None,
-                 extras=None, link_patterns=None, use_file_vars=False):
+                 extras=None, link_patterns=None, use_file_vars=False,
+                 cache=None):
         if html4tags:
             self.empty_element_suffix = ">"
         else:
@@ -231,20 +252,40 @@ class Markdown(object):
 
         self.link_patterns = link_patterns
         self.use_file_vars = use_file_vars
-        self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
+        if cache is not None:
+            self.cache = cache
+        self._outdent_re = _outdent_re_from_tab_width(tab_width)
 
-        self._escape_table = g_escape_table.copy()
-        if "smarty-pants" in self.extras:
-            self._escape_table['"'] = _hash_text('"')
-            self._escape_table["'"] = _hash_text("'")
-
-    def reset(self):
-        self.urls = {}
-        self.titles = {}
-        self.html_blocks = {}
-        self.html_spans = {}
+    def reset(self, extras=None):
+        """Clear the per-document state before a conversion.
+
+        `extras` are merged over the instance's extras for this
+        conversion only, so one instance can serve documents with
+        different extras without being rebuilt.
+        """
+        # These hashes never escape a conversion, so reuse them.
+        if self.urls is None:
+            self.urls = {}
+            self.titles = {}
+            self.html_blocks = {}
+            self.html_spans = {}
+        else:
+            self.urls.clear()
+            self.titles.clear()
+            self.html_blocks.clear()
+            self.html_spans.clear()
         self.list_level = 0
+        self._toc = None
         self.extras = self._instance_extras.copy()
+        if extras:
+            self.extras.update(_extras_dict(extras))
+            if "toc" in self.extras and not "header-ids" in self.extras:
+                self.extras["header-ids"] = None   # "toc" implies "header-ids"
+        # `_encode_code()` adds entries, so each document needs its own copy.
+        if "smarty-pants" in self.extras:
+            self._escape_table = g_smarty_escape_table.copy()
+        else:
+            self._escape_table = g_escape_table.copy()
         if "footnotes" in self.extras:
             self.footnotes = {}
             self.footnote_ids = []
@@ -257,8 +298,25 @@ class Markdown(object):
     # should only be used in <a> tags with an "href" attribute.
     _a_nofollow = re.compile(r"<(a)([^>]*href=)", re.IGNORECASE)
 
-    def convert(self, text):
-        """Convert the given text."""
+    def convert(self, text, extras=None):
+        """Convert the given text.
+
+        `extras` are added to the instance's extras for this call only.
+        If a `RenderCache` was given, the result for the same text and
+        options is looked up there first.
+        """
+        if self.cache is None:
+            return self._convert(text, extras)
+        if not isinstance(text, unicode):
+            text = unicode(text, 'utf-8')
+        digest = self.cache.digest(text, self, extras)
+        rv = self.cache.get(digest)
+        if rv is None:
+            rv = self._convert(text, extras)
+            self.cache.put(digest, rv)
+        return rv
+
+    def _convert(self, text, extras=None):
         # Main function. The order in which other subs are called here is
         # essential. Link and image substitutions need to happen before
         # _EscapeSpecialChars(), so that any *'s or _'s in the <a>
@@ -268,7 +326,7 @@ class Markdown(object):
         # from other articles when generating a page which contains more than
         # one article (e.g. an index page that shows the N most recent
         # articles):
-        self.reset()
+        self.reset(extras)
 
         if not isinstance(text, unicode):
             #TODO: perhaps shouldn't presume UTF-8 for string input?
@@ -2013,8 +2071,183 @@ class MarkdownWithExtras(Markdown):
     extras = ["footnotes", "code-color"]
 
 
+class RenderCache(object):
+    """A content-addressed cache of `Markdown.convert()` results.
+
+    Entries are keyed on a SHA-1 digest of the input text plus every
+    option that affects the output (extras, safe_mode, tab_width, ...).
+    The first tier is an in-memory LRU of `maxsize` entries. If
+    `cache_dir` is given, results are also written there, one file per
+    digest, and memory-mapped when read back. Safe to share between
+    threads.
+
+        >>> cache = RenderCache(maxsize=128, cache_dir="/tmp/md-cache")
+        >>> html = markdown(text, extras=["toc"], cache=cache)
+    """
+    def __init__(self, maxsize=256, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()  # digest -> (html, toc, metadata)
+        self._lock = threading.Lock()
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def digest(self, text, markdowner, extras=None):
+        """Return the cache key for converting `text` with `markdowner`
+        and the per-call `extras`.
+        """
+        cls = markdowner.__class__
+        all_extras = markdowner._instance_extras.copy()
+        if extras:
+            all_extras.update(_extras_dict(extras))
+        options = ("%s.%s" % (cls.__module__, cls.__name__),
+                   markdowner.empty_element_suffix,
+                   markdowner.tab_width,
+                   markdowner.safe_mode,
+                   sorted(all_extras.items()),
+                   markdowner.link_patterns,
+                   markdowner.use_file_vars)
+        h = sha1(repr(options).encode("utf-8"))
+        h.update(b"\0")
+        h.update(text.encode("utf-8"))
+        return h.hexdigest()
+
+    def get(self, digest):
+        """Return a fresh `UnicodeWithAttrs` for `digest`, or None."""
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                self._entries.move_to_end(digest)
+        if entry is None and self.cache_dir:
+            entry = self._read(digest)
+            if entry is not None:
+                self._remember(digest, entry)
+        if entry is None:
+            return None
+        return self._result(entry)
+
+    def put(self, digest, rv):
+        entry = (unicode(rv), rv._toc, rv.metadata)
+        self._remember(digest, entry)
+        if self.cache_dir:
+            self._write(digest, entry)
+
+    def clear(self):
+        """Empty the in-memory tier. Files in `cache_dir` are kept."""
+        with self._lock:
+            self._entries.clear()
+
+    def _remember(self, digest, entry):
+        with self._lock:
+            self._entries[digest] = entry
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _result(self, entry):
+        html, toc, metadata = entry
+        rv = UnicodeWithAttrs(html)
+        if toc is not None:
+            rv._toc = [tuple(t) for t in toc]
+        if metadata is not None:
+            rv.metadata = dict(metadata)
+        return rv
+
+    def _path(self, digest):
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    # On-disk format: a one-line JSON header holding the toc and
+    # metadata, then the UTF-8 encoded HTML.
+    def _read(self, digest):
+        try:
+            f = open(self._path(digest), "rb")
+        except (IOError, OSError):
+            return None
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                nl = m.find(b"\n")
+                header = json.loads(m[:nl].decode("utf-8"))
+                html = m[nl+1:].decode("utf-8")
+            finally:
+                m.close()
+        except (ValueError, KeyError, EnvironmentError):
+            log.warning("ignoring corrupt render cache file for %s", digest)
+            return None
+        finally:
+            f.close()
+        return (html, header["toc"], header["metadata"])
+
+    def _write(self, digest, entry):
+        html, toc, metadata = entry
+        path = self._path(digest)
+        tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            f = open(tmp, "wb")
+            try:
+                f.write(json.dumps({"toc": toc, "metadata": metadata}).encode("utf-8"))
+                f.write(b"\n")
+                f.write(html.encode("utf-8"))
+            finally:
+                f.close()
+            os.rename(tmp, path)  # atomic, readers never see a partial file
+        except (IOError, OSError):
+            log.warning("could not write render cache file %s", path, exc_info=True)
+
+
+class MarkdownPool(object):
+    """A thread-safe pool of reusable `Markdown` instances.
+
+    Every instance in the pool is built once with `options` (the
+    `Markdown` constructor arguments) and reused across documents;
+    different extras can be given per call. At most `maxsize` idle
+    instances are kept.
+
+        >>> pool = MarkdownPool(safe_mode="escape")
+        >>> html = pool.convert(text, extras=["fenced-code-blocks"])
+    """
+    def __init__(self, maxsize=8, **options):
+        self.maxsize = maxsize
+        self.options = options
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def convert(self, text, extras=None):
+        with self._lock:
+            markdowner = self._idle and self._idle.pop() or None
+        if markdowner is None:
+            markdowner = Markdown(**self.options)
+        try:
+            return markdowner.convert(text, extras=extras)
+        finally:
+            with self._lock:
+                if len(self._idle) < self.maxsize:
+                    self._idle.append(markdowner)
+
+# Pools used by `markdown()`, one per combination of constructor options.
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _get_pool(**options):
+    key = tuple(sorted(options.items()))
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = MarkdownPool(**options)
+    return pool
+
+
 #---- internal support functions
 
+def _extras_dict(extras):
+    if isinstance(extras, dict):
+        return extras
+    return dict([(e, None) for e in extras])
+
 class UnicodeWithAttrs(unicode):
     """A subclass of unicode used for the return value of conversion to
     possibly attach some attributes. E.g. the "toc_html" attribute when
@@ -2223,6 +2456,11 @@ class _memoized(object):
       return self.func.__doc__
 
 
+def _outdent_re_from_tab_width(tab_width):
+    """Regex removing one level of line-leading tabs or spaces."""
+    return re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
+_outdent_re_from_tab_width = _memoized(_outdent_re_from_tab_width)
+
 def _xml_oneliner_re_from_tab_width(tab_width):
     """Standalone XML processing instruction regex."""
     return re.compile(r"""
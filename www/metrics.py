@@ -0,0 +1,96 @@
+#进程内的运行指标，以Prometheus的文本格式输出(见handlers.metrics)
+#指标只在本进程内累计，prefork.py启动多个worker时，每次抓取只能拿到处理这个请求的worker的数据
+
+import bisect
+
+#所有指标按创建顺序登记在这里，render()依次输出
+REGISTRY = []
+
+def _escape(value):
+	return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+def _labels(names,values,extra=None):
+	pairs = ['%s="%s"' % (n,_escape(v)) for n,v in zip(names,values)]
+	if extra is not None:
+		pairs.append('%s="%s"' % extra)
+	return '{%s}' % ','.join(pairs) if pairs else ''
+
+def _number(value):
+	if value == float('inf'):
+		return '+Inf'
+	return repr(float(value)) if isinstance(value,float) else str(value)
+
+class Counter(object):
+	type = 'counter'
+
+	def __init__(self,name,help,labels=()):
+		self.name = name
+		self.help = help
+		self.labelnames = tuple(labels)
+		self._values = {}   #标签值的tuple => 数值
+		REGISTRY.append(self)
+
+	#标签值按创建时labels的顺序传入
+	def inc(self,*labelvalues,value=1):
+		self._values[labelvalues] = self._values.get(labelvalues,0) + value
+
+	def collect(self):
+		for labelvalues,value in sorted(self._values.items()):
+			yield '%s%s %s' % (self.name,_labels(self.labelnames,labelvalues),_number(value))
+
+class Gauge(Counter):
+	type = 'gauge'
+
+	def dec(self,*labelvalues,value=1):
+		self.inc(*labelvalues,value=-value)
+
+	def set(self,*labelvalues,value):
+		self._values[labelvalues] = value
+
+#直方图：每个观测值落入第一个不小于它的桶，输出时再累加成Prometheus要求的累计计数
+class Histogram(Counter):
+	type = 'histogram'
+
+	def __init__(self,name,help,labels=(),buckets=(.005,.01,.025,.05,.1,.25,.5,1,2.5,5,10)):
+		super(Histogram,self).__init__(name,help,labels)
+		self.buckets = tuple(sorted(buckets))
+
+	def observe(self,value,*labelvalues):
+		entry = self._values.get(labelvalues)
+		if entry is None:
+			#每个桶的计数(最后一个是+Inf)、总和、总数
+			entry = self._values[labelvalues] = [[0] * (len(self.buckets) + 1),0,0]
+		entry[0][bisect.bisect_left(self.buckets,value)] += 1
+		entry[1] += value
+		entry[2] += 1
+
+	def collect(self):
+		for labelvalues,(counts,total,count) in sorted(self._values.items()):
+			cumulative = 0
+			for bound,n in zip(self.buckets + (float('inf'),),counts):
+				cumulative += n
+				yield '%s_bucket%s %s' % (self.name,_labels(self.labelnames,labelvalues,('le',_number(bound))),cumulative)
+			yield '%s_sum%s %s' % (self.name,_labels(self.labelnames,labelvalues),_number(total))
+			yield '%s_count%s %s' % (self.name,_labels(self.labelnames,labelvalues),count)
+
+def render():
+	lines = []
+	for metric in REGISTRY:
+		lines.append('# HELP %s %s' % (metric.name,metric.help))
+		lines.append('# TYPE %s %s' % (metric.name,metric.type))
+		lines.extend(metric.collect())
+	return '\n'.join(lines) + '\n'
+
+_BYTES_BUCKETS = (256,1024,4096,16384,65536,262144,1048576)
+
+#http请求，route是注册路由时的路径模式(如/blog/{id})，不是请求的实际路径，避免每篇博客都产生一组新的指标
+http_requests = Counter('http_requests_total','HTTP requests by route and status.',('method','route','status'))
+http_request_seconds = Histogram('http_request_duration_seconds','HTTP request latency.',('method','route'))
+http_in_flight = Gauge('http_requests_in_flight','HTTP requests being handled.')
+http_request_bytes = Histogram('http_request_size_bytes','HTTP request body size.',('method','route'),_BYTES_BUCKETS)
+http_response_bytes = Histogram('http_response_size_bytes','HTTP response body size.',('method','route'),_BYTES_BUCKETS)
+
+#数据库，op为select或execute
+db_queries = Counter('db_queries_total','SQL statements executed.',('op',))
+db_query_seconds = Histogram('db_query_duration_seconds','SQL statement latency.',('op',),(.001,.0025,.005,.01,.025,.05,.1,.25,.5,1,2.5))
+db_pool_wait_seconds = Histogram('db_pool_wait_seconds','Time spent waiting for a pooled connection.',(),(.0001,.0005,.001,.005,.01,.05,.1,.5,1))
@@ -1,16 +1,24 @@
 import time
 #uuid 是python 中生成唯一ID的库
 import uuid 
-from orm import Model,StringField,BooleanField,FloatField,TextField
+import markdown2
+from orm import Model,Index,StringField,BooleanField,FloatField,TextField,transaction,execute,count_cache
+from cache import session_cache
 
 def next_id():
 	#time.time()返回当前时间的时间戳
 	#uuid4()是由伪随机数得到，有一定的重复概率，该概率可以计算出来
 	return "%015d%s000"%(int(time.time()*1000),uuid.uuid4().hex)
 
+#博客正文渲染器的版本，markdown2升级或渲染参数变化时修改它
+#render_version与它不一致的博客会在下次被访问时重新渲染(见handlers.get_blog)
+RENDER_VERSION = 'markdown2-%s'%markdown2.__version__
+
 #这是一个用户名的表
 class User(Model):
 	__table__ = 'users'
+	__batch_find__ = True   #合并同一轮事件循环内的find(pk)查询
+	__indexes__ = (Index('email',unique=True),Index('created_at'))
 
 	id = StringField(primary_key=True,default=next_id,ddl='varchar(50)')
 	email = StringField(ddl='varchar(50)')
@@ -20,10 +28,21 @@ class User(Model):
 	image = StringField(ddl='varchar(500)')
 	created_at = FloatField(default=time.time)       #创建时间的缺省值是函数time.time，设置为当前日期和时间
 
+	#用户信息被修改或删除后，作废该用户所有已缓存的session
+	async def update(self):
+		await super().update()
+		session_cache.forget_user(self.id)
+
+	async def remove(self):
+		await super().remove()
+		session_cache.forget_user(self.id)
+
 #这是一个博客表
 class Blog(Model):
 	"""docstring for Blog"""
 	__table__ = 'blogs'
+	__batch_find__ = True   #合并同一轮事件循环内的find(pk)查询
+	__indexes__ = (Index('created_at'),)
 
 	id = StringField(primary_key=True,default=next_id,ddl='varchar(50)')
 	# email = StringField(ddl='varchar(50)')
@@ -35,13 +54,42 @@ class Blog(Model):
 	name = StringField(ddl='varchar(50)')
 	summary = StringField(ddl='varchar(200)')
 	content = TextField()
+	html_content = TextField(default='')   #写入时预先渲染好的html，浏览时直接使用
+	render_version = StringField(ddl='varchar(50)',default='')  #渲染html_content时使用的RENDER_VERSION
 	created_at = FloatField(default=time.time) 
 
+	#把markdown格式的content渲染为html，保存到html_content并打上版本戳
+	#html不为None时表示已经在别处(如renderer的进程池)渲染好了，直接使用
+	def render(self,html=None):
+		self.html_content = markdown2.markdown(self.content) if html is None else html
+		self.render_version = RENDER_VERSION
+		return self.html_content
+
+	#html_content是否需要重新渲染
+	def needs_render(self):
+		return self.render_version != RENDER_VERSION
+
+	#浏览时补渲染后的回写：只写渲染结果这两列，并且只在数据库中仍是旧版本stale_version时才写
+	#读出博客之后正文可能已被修改(修改时会重新渲染)，整行update会用读到的旧正文覆盖它
+	async def save_render(self,stale_version):
+		return await execute('update `%s` set `html_content`=?,`render_version`=? where `%s`=? and `render_version`=?'%(self.__table__,self.__primary_key__),
+			[self.html_content,self.render_version,self.id,stale_version])
+
+	#删除博客时同时删除它的全部评论，两条语句在同一个事务中执行
+	async def remove(self):
+		async with transaction():
+			await super().remove()
+			rows = await execute('delete from `%s` where `blog_id`=?'%Comment.__table__,[self.id])
+		count_cache.incr(Comment,-rows)
+
 #这是一个评论的表
 class Comment(Model):
 	__table__ = 'comments'
+	__batch_find__ = True   #合并同一轮事件循环内的find(pk)查询
+	#博客详情页按blog_id取评论并按created_at排序，组合索引让它成为索引范围扫描，不需要filesort
+	__indexes__ = (Index('blog_id','created_at'),Index('created_at'))
 
-	id = StringField(primary_key=True,default=next_id)
+	id = StringField(primary_key=True,default=next_id,ddl='varchar(50)')
 	blog_id = StringField(ddl='varchar(50)') #博客id
 	user_id = StringField(ddl='varchar(50)')  #评论者id
 	user_name = StringField(ddl='varchar(50)')  #评论者名字
@@ -1,11 +1,77 @@
 import asyncio
 import logging
+import time
+import random
+import contextlib
+import contextvars
+from collections import deque
 #aiomysql是MySQL的python异步驱动程序，操作数据库要用到
 import aiomysql
+import metrics
+from cache import broadcast,subscribe
 
-#输出信息，让你知道这个时间点程序在做什么
-def log(sql,args=()):
-	logging.info('SQL:%s'%sql)
+#====================================SQL日志======================================
+#每条SQL执行后调用QueryLog.record：普通语句按sample_rate抽样写入日志，避免每条语句都格式化一次
+#耗时超过slow_threshold(秒)的语句连同参数记录到有容量上限的环形缓冲区(由/api/slow_queries读取)
+#并在后台用另一个连接执行EXPLAIN，把执行计划附在记录上，用来发现缺少的索引
+#EXPLAIN只对select/update/delete执行，同一条SQL已经有执行计划时直接复用
+class QueryLog(object):
+	def __init__(self,sample_rate=0.0,slow_threshold=0.1,explain=True,maxlen=100):
+		self.sample_rate = sample_rate        #普通语句写入日志的比例，0表示不写，1表示全部写入
+		self.slow_threshold = slow_threshold  #慢查询的阈值(秒)，None表示不记录慢查询
+		self.explain = explain
+		self._slow = deque(maxlen=maxlen)
+		self._explaining = {}   #正在EXPLAIN的sql => 等待执行计划的条目，同一条语句只EXPLAIN一次
+
+	def record(self,op,sql,args,elapsed,rows):
+		if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+			self._record_slow(op,sql,args,elapsed,rows)
+		elif self.sample_rate and random.random() < self.sample_rate:
+			#参数中可能有邮箱、口令哈希等用户数据，抽样日志中不写参数，只有慢查询才记录
+			logging.info('SQL(%.1fms,%s rows):%s',elapsed * 1000,rows,sql)
+
+	def _record_slow(self,op,sql,args,elapsed,rows):
+		entry = dict(time=time.time(),op=op,sql=sql,args=_clip_args(args),elapsed_ms=round(elapsed * 1000,3),rows=rows,plan=None)
+		logging.warning('slow SQL(%.1fms,%s rows):%s args:%s',elapsed * 1000,rows,sql,entry['args'])
+		if self.explain and sql.lstrip()[:6].lower() in ('select','update','delete'):
+			if sql in self._explaining:
+				self._explaining[sql].append(entry)
+			else:
+				for old in self._slow:
+					if old['sql'] == sql and old['plan'] is not None:
+						entry['plan'] = old['plan']
+						break
+				else:
+					self._explaining[sql] = [entry]
+					asyncio.ensure_future(self._explain(sql,args))
+		self._slow.append(entry)
+
+	async def _explain(self,sql,args):
+		try:
+			async with _connection() as conn:
+				async with conn.cursor(aiomysql.DictCursor) as cur:
+					await cur.execute('explain ' + sql.replace('?','%s'),args or ())
+					plan = await cur.fetchall()
+		except Exception as e:
+			logging.warning('failed to explain SQL:%s (%s)',sql,e)
+			plan = 'explain failed: %s' % e
+		finally:
+			entries = self._explaining.pop(sql,[])
+		for entry in entries:
+			entry['plan'] = plan
+
+	#最近的慢查询，最新的在前
+	def entries(self):
+		return list(reversed(self._slow))
+
+	def clear(self):
+		self._slow.clear()
+
+#参数中过长的字符串(如博客正文)只保留开头
+def _clip_args(args,width=200):
+	return [a[:width] + '...' if isinstance(a,str) and len(a) > width else a for a in (args or ())]
+
+query_log = QueryLog()
 
 #创建全局连接池，使每个HTTP请求都可以从连接池中直接获取数据库连接
 #避免频繁地打开和关闭数据库连接
@@ -28,46 +94,146 @@ async def create_pool(loop,**kw):
 		loop = loop #传递消息循环对象，用于异步执行
 	)
 
+#关闭连接池，等待所有连接归还并关闭，用于进程退出前
+async def close_pool():
+	global __pool
+	__pool.close()
+	await __pool.wait_closed()
+
+#使用在别处创建好的连接池，如bench/sqlite_pool.py中基于SQLite的连接池
+#连接池需要提供和aiomysql相同的接口：get()、close()、wait_closed()
+def set_pool(pool):
+	global __pool
+	__pool = pool
+
+#从连接池取得一个连接，同时记录等待空闲连接的时间，连接池太小时这个时间会明显上升
+#当前任务在事务中时直接使用事务的连接，见transaction()
+@contextlib.asynccontextmanager
+async def _connection():
+	tx = _current_transaction()
+	if tx is not None:
+		yield tx.conn
+		return
+	start = time.perf_counter()
+	async with __pool.get() as conn:
+		metrics.db_pool_wait_seconds.observe(time.perf_counter() - start)
+		yield conn
+
+#====================================事务======================================
+#当前的事务，保存在contextvars中，每个任务有自己的值
+_transaction = contextvars.ContextVar('orm_transaction',default=None)
+
+class _Transaction(object):
+	def __init__(self,conn):
+		self.conn = conn
+		self.task = asyncio.current_task()   #开启事务的任务
+		self.savepoints = 0                  #已创建的保存点数，用于生成不重复的保存点名
+
+#只有开启事务的任务本身使用事务的连接
+#事务中用ensure_future等方式创建的任务会继承contextvars，但它们和事务并发执行，不能共用一个连接，仍然从连接池取得连接
+def _current_transaction():
+	tx = _transaction.get()
+	if tx is not None and tx.task is asyncio.current_task():
+		return tx
+	return None
+
+async def _run(conn,sql):
+	async with conn.cursor() as cur:
+		await cur.execute(sql)
+
+#事务，用法：
+#	async with orm.transaction():
+#		await blog.remove()
+#		await orm.execute('delete from `comments` where `blog_id`=?',[blog.id])
+#块内当前任务的select/execute都使用同一个连接，正常结束时提交，发生异常时回滚
+#嵌套使用时内层是一个保存点(savepoint)：内层发生异常只回滚到保存点，外层捕获异常后可以继续执行并提交
+#块内的Model.find不经过FindLoader合并，保证能读到本事务中未提交的修改
+#注意：块内select_stream遍历结束之前，不能在同一事务中执行其他语句
+#回滚后count_cache中可能已经计入了被回滚的增减，直接清空
+@contextlib.asynccontextmanager
+async def transaction():
+	tx = _current_transaction()
+	if tx is not None:
+		tx.savepoints += 1
+		name = 'sp_%d'%tx.savepoints
+		await _run(tx.conn,'savepoint %s'%name)
+		try:
+			yield tx.conn
+		except BaseException:
+			await _run(tx.conn,'rollback to savepoint %s'%name)
+			count_cache.clear()
+			raise
+		await _run(tx.conn,'release savepoint %s'%name)
+		return
+	async with _connection() as conn:
+		await conn.begin()   #显式开启事务，连接池默认是自动提交模式
+		token = _transaction.set(_Transaction(conn))
+		try:
+			yield conn
+		except BaseException:
+			await conn.rollback()
+			count_cache.clear()
+			raise
+		else:
+			await conn.commit()
+		finally:
+			_transaction.reset(token)
+
+#记录一条SQL语句的执行时间和返回/影响的行数，op为select或execute
+def _observe(op,sql,args,elapsed,rows):
+	metrics.db_queries.inc(op)
+	metrics.db_query_seconds.observe(elapsed,op)
+	query_log.record(op,sql,args,elapsed,rows)
+
 #将要执行的SQL语句封装成select函数，调用时只要传入SQL和sql所需的参数就好
 #sql参数即为sql语句，args表示要搜索的参数
 #size用于指定最大查询数量，不指定将返回全部结果
+#as_tuple为True时每条记录是按列顺序排列的tuple，不再为每条记录创建dict，供紧凑行对象(Row)使用
 
 
-async def select(sql,args,size=None):
-	log(sql,args)
-	#声明全局变量，引用create_pool函数创建的__pool变量
-	global __pool
+async def select(sql,args,size=None,as_tuple=False):
 	#用with语句可以封装清理(关闭conn)和处理异常
-	async with __pool.get() as conn:
-		async with conn.cursor(aiomysql.DictCursor) as cur:
-			#从连接池获得一个数据库连接
-				#cur = yield from conn.cursor(aiomysql.DictCursor)
-				#设置执行语句，其中?为sql语句的占位符，而%s为python的占位符，这里做下转换
+	async with _connection() as conn:
+		async with conn.cursor(aiomysql.Cursor if as_tuple else aiomysql.DictCursor) as cur:
+			start = time.perf_counter()
+			#设置执行语句，其中?为sql语句的占位符，而%s为python的占位符，这里做下转换
 			await cur.execute(sql.replace('?','%s'), args or ())
-				#如果指定了查询数量则返回指定的查询数量，否则返回全部查询
+			#如果指定了查询数量则返回指定的查询数量，否则返回全部查询
 			if size:
 				rs = await cur.fetchmany(size)
 			else:
 				rs = await cur.fetchall()
-		
-		logging.info('rows returned:%s'%len(rs))
+			_observe('select',sql,args,time.perf_counter() - start,len(rs))
 		return rs            #返回结果集
 
+#流式查询，使用无缓冲的服务端游标(SSDictCursor)，结果集不会一次性全部读入内存
+#这是一个异步生成器，每次产出最多batch_size条记录组成的list，适合导出、重建索引等需要遍历整张表的后台任务
+#注意：遍历期间会一直占用连接池中的一个连接，直到生成器结束或被关闭
+async def select_stream(sql,args,batch_size=1000,as_tuple=False):
+	async with _connection() as conn:
+		async with conn.cursor(aiomysql.SSCursor if as_tuple else aiomysql.SSDictCursor) as cur:
+			#只统计执行语句的时间，之后读取结果的快慢取决于调用者
+			start = time.perf_counter()
+			await cur.execute(sql.replace('?','%s'), args or ())
+			_observe('select',sql,args,time.perf_counter() - start,None)
+			while True:
+				rs = await cur.fetchmany(batch_size)
+				if not rs:
+					break
+				yield rs
+
 #要执行INSERT、UPDATE、DELETE语句，定义一个通用的execute()函数
+#autocommit为False时这一条语句在单独的事务中执行；已经在事务中时直接使用当前事务
 async def execute(sql,args,autocommit=True):
-	log(sql)
-	async with __pool.get() as conn:
-		try:
-			async with conn.cursor(aiomysql.DictCursor) as cur:
-			#cur = yield from conn.cursor()
-				await cur.execute(sql.replace('?','%s'),args)
-				affected = cur.rowcount    #返回受影响行数
-			if not autocommit:
-				await conn.commit()
-		except BaseException as e:
-			if not autocommit:
-				await conn.rollback()
-			raise
+	if not autocommit and _current_transaction() is None:
+		async with transaction():
+			return await execute(sql,args)
+	async with _connection() as conn:
+		async with conn.cursor(aiomysql.DictCursor) as cur:
+			start = time.perf_counter()
+			await cur.execute(sql.replace('?','%s'),args)
+			affected = cur.rowcount    #返回受影响行数
+			_observe('execute',sql,args,time.perf_counter() - start,affected)
 		return affected
 
 #这个函数在元类中被引用，作用是创建一定数量的占位符
@@ -77,6 +243,132 @@ def create_args_string(num):
 		L.append('?')
 	return ','.join(L)
 
+#====================================批量find加载器======================================
+#同一轮事件循环中对同一个Model的多次find(pk)会被收集起来，合并成一条 where `pk` in (...) 查询
+#重复的主键只查询一次，但每个调用者都会拿到自己独立的实例，互不影响
+#一条IN查询中最多放入的主键数量，超过则拆成多条查询
+_LOADER_MAX_KEYS = 500
+
+class FindLoader(object):
+	def __init__(self,model):
+		self.model = model
+		self._pending = {}       #主键 => 等待结果的future列表
+		self._scheduled = False  #本轮是否已经安排了批量查询
+
+	def load(self,pk):
+		loop = asyncio.get_event_loop()
+		fut = loop.create_future()
+		self._pending.setdefault(pk,[]).append(fut)
+		if not self._scheduled:
+			#call_soon会在当前已就绪的回调全部执行完之后才执行，也就是这一轮的find都已经收集完毕
+			self._scheduled = True
+			loop.call_soon(self._dispatch)
+		return fut
+
+	def _dispatch(self):
+		pending,self._pending = self._pending,{}
+		self._scheduled = False
+		asyncio.ensure_future(self._fetch(pending))
+
+	async def _fetch(self,pending):
+		model = self.model
+		keys = list(pending.keys())
+		rows = {}
+		try:
+			for i in range(0,len(keys),_LOADER_MAX_KEYS):
+				chunk = keys[i:i+_LOADER_MAX_KEYS]
+				rs = await select('%s where `%s` in (%s)'%(model.__select__,model.__primary_key__,create_args_string(len(chunk))),chunk)
+				for r in rs:
+					rows[r[model.__primary_key__]] = r
+		except BaseException as e:
+			for futs in pending.values():
+				for f in futs:
+					if not f.done():
+						f.set_exception(e)
+			return
+		for pk,futs in pending.items():
+			r = rows.get(pk)
+			for f in futs:
+				if not f.done():
+					f.set_result(None if r is None else model(**r))
+
+#每个Model子类各自持有一个加载器
+def get_loader(model):
+	loader = model.__dict__.get('__loader__')
+	if loader is None:
+		loader = FindLoader(model)
+		model.__loader__ = loader
+	return loader
+
+#====================================行数缓存======================================
+#分页时每次都要select count(id)，在InnoDB上这是一次全索引扫描，这里把结果按(表名,where,args)缓存起来
+#不带where的表总数在save/remove时直接增减；带where的条目无法判断新记录是否满足条件，写入时直接作废
+#条目过期后先返回旧值，同时在后台刷新，请求不会被count查询阻塞
+class CountCache(object):
+	def __init__(self,ttl=60,estimate_over=None):
+		self.ttl = ttl                      #缓存有效期(秒)
+		self.estimate_over = estimate_over  #表的估算行数超过这个值时直接使用information_schema中的估算值，None表示不估算
+		self._entries = {}                  #(表名,where,args) => [行数,过期时间]
+		self._refreshing = set()            #正在后台刷新的key
+
+	async def get(self,model,where=None,args=None):
+		where = where or None
+		key = (model.__table__,where,tuple(args or ()))
+		entry = self._entries.get(key)
+		if entry is not None:
+			if entry[1] < time.time() and key not in self._refreshing:
+				self._refreshing.add(key)
+				asyncio.ensure_future(self._refresh(key,model,where,args))
+			return entry[0]
+		value = await self._load(model,where,args)
+		self._entries[key] = [value,time.time() + self.ttl]
+		return value
+
+	async def _refresh(self,key,model,where,args):
+		try:
+			value = await self._load(model,where,args)
+			self._entries[key] = [value,time.time() + self.ttl]
+		except Exception as e:
+			logging.exception(e)
+		finally:
+			self._refreshing.discard(key)
+
+	async def _load(self,model,where,args):
+		if self.estimate_over is not None and where is None:
+			rs = await select('select `table_rows` _num_ from information_schema.tables where `table_schema`=database() and `table_name`=?',[model.__table__],1)
+			if len(rs) > 0 and rs[0]['_num_'] is not None and rs[0]['_num_'] > self.estimate_over:
+				return rs[0]['_num_']
+		return await model.findNumber('count(`%s`)'%model.__primary_key__,where,args)
+
+	#插入或删除了n行(删除时n为负数)，同样的修改会广播给其他worker(见cache.broadcast)
+	def incr(self,model,n):
+		self.apply(model.__table__,n)
+		broadcast('count',model.__table__,n)
+
+	def apply(self,table,n):
+		for key in list(self._entries.keys()):
+			if key[0] != table:
+				continue
+			if key[1] is None:
+				self._entries[key][0] += n
+			else:
+				del self._entries[key]
+
+	#更新可能改变where条件的匹配结果，作废该表所有带where的条目
+	def invalidate(self,model):
+		self.incr(model,0)
+
+	def clear(self):
+		self.reset()
+		broadcast('count_clear')
+
+	def reset(self):
+		self._entries.clear()
+
+count_cache = CountCache()
+subscribe('count',count_cache.apply)
+subscribe('count_clear',count_cache.reset)
+
 #====================================Field定义域区======================================
 #父定义域，可以被其他定义域继承
 class Field(object):
@@ -96,7 +388,7 @@ class StringField(Field):
 
 class BooleanField(Field):
 	def __init__(self,name=None,default=False):
-		super().__init__(name,'boolean',False,default)
+		super().__init__(name,'bool',False,default)
 
 class IntergerField(Field):
 	def __init__(self,name=None,primary_key=False,default=0):
@@ -104,12 +396,25 @@ class IntergerField(Field):
 
 class FloatField(Field):
 	def __init__(self,name=None,default=None):
-		super().__init__(name,'text',False,default)
+		super().__init__(name,'real',False,default)
 class TextField(Field):
 	def __init__(self,name=None,default=None):
-		super().__init__(name,'text',False,default)
+		super().__init__(name,'mediumtext',False,default)
+
+#索引声明，Model中通过__indexes__列出，例如：
+#	__indexes__ = (Index('email',unique=True),Index('blog_id','created_at'))
+#组合索引的列按声明的顺序排列，name默认为idx_列名1_列名2
+class Index(object):
+	def __init__(self,*columns,unique=False,name=None):
+		if not columns:
+			raise ValueError('index must have at least one column.')
+		self.columns = columns
+		self.unique = unique
+		self.name = name or 'idx_%s'%'_'.join(columns)
+
+	def __str__(self):
+		return '<%s%s,%s>'%('unique ' if self.unique else '',self.name,','.join(self.columns))
 
-		
 
 #编写元类
 class ModelMetaclass(type):
@@ -138,6 +443,13 @@ class ModelMetaclass(type):
 		#如果没有找到主键，也会报错
 		if not primaryKey:
 			raise StandardError('Primary key not found.')
+		#索引中的列必须是已定义的属性
+		indexes = tuple(attrs.get('__indexes__',()))
+		for index in indexes:
+			for column in index.columns:
+				if column not in mappings:
+					raise ValueError('Index %s of %s refers to unknown field:%s'%(index.name,name,column))
+		attrs['__indexes__'] = indexes
 		#定义域中的key值已经添加到fields里了，就要在attrs中删除，避免重名导致运行时错误
 		for k in mappings.keys():
 			attrs.pop(k)
@@ -149,17 +461,124 @@ class ModelMetaclass(type):
 		attrs['__fields__'] = fields   #除主键外的属性名
 		#构造默认的select，insert，update和delete语句:
 		attrs['__select__'] = 'select `%s`,%s from `%s`'%(primaryKey,','.join(escaped_fields),tableName)
-		attrs['__insert__'] = 'insert into `%s`(%s,`%s`) values(%s)'%(tableName,','.join(escaped_fields),primaryKey,create_args_string(len(escaped_fields)+1))
+		#__insert_head__和__insert_row__拆开保存，供save_many拼接多行INSERT语句
+		attrs['__insert_head__'] = 'insert into `%s`(%s,`%s`)'%(tableName,','.join(escaped_fields),primaryKey)
+		attrs['__insert_row__'] = '(%s)'%create_args_string(len(escaped_fields)+1)
+		attrs['__insert__'] = '%s values%s'%(attrs['__insert_head__'],attrs['__insert_row__'])
 		attrs['__update__'] = 'update `%s` set %s where `%s`=?'%(tableName,','.join(map(lambda f:'`%s`=?'%(mappings.get(f).name or f),fields)),primaryKey)
 		attrs['__delete__'] = 'delete from `%s` where `%s`=?'%(tableName,primaryKey)
+		attrs['__projections__'] = {}   #(only,defer) => (select语句,没有取的列)，见Model._projection
+		#紧凑行对象的类，列的顺序和__select__相同；__row_classes__为 没有取的列 => Row子类
+		attrs['__row__'] = make_row_class(name,[primaryKey] + fields)
+		attrs['__row_classes__'] = {():attrs['__row__']}
 		return type.__new__(cls,name,bases,attrs)
 
+#访问查询时没有取出的列(见Model.findAll的only/defer参数)
+#数据库访问是异步的，不能在属性访问时同步加载，需要先await obj.load()
+class DeferredFieldError(AttributeError):
+	pass
+
+#==========================================DDL=======================================================
+#由Model的定义生成建表语句，格式和schema.sql相同，所有列都是not null
+def create_table_sql(model):
+	lines = ['    `%s` %s not null,'%(f.name or k,f.column_type) for k,f in model.__mappings__.items()]
+	for index in model.__indexes__:
+		lines.append('    %skey `%s` (%s),'%('unique ' if index.unique else '',index.name,_index_columns(index)))
+	lines.append('    primary key (`%s`)'%model.__primary_key__)
+	return 'create table %s (\n%s\n) engine=innodb default charset=utf8;'%(model.__table__,'\n'.join(lines))
+
+#在已有的表上补建索引
+def create_index_sql(model,index):
+	return 'create %sindex `%s` on `%s` (%s);'%('unique ' if index.unique else '',index.name,model.__table__,_index_columns(index))
+
+def _index_columns(index):
+	return ', '.join('`%s`'%c for c in index.columns)
+
+#对比Model声明的索引和数据库中实际的索引(information_schema.statistics)，返回缺少的索引
+#已有索引的前几列和声明的列相同时也算满足，例如(blog_id,created_at)可以代替(blog_id)
+#声明为unique的索引只能由列完全相同的unique索引满足
+async def missing_indexes(model):
+	rs = await select('select `index_name` _name_,`column_name` _column_,`non_unique` _non_unique_ from information_schema.statistics where `table_schema`=database() and `table_name`=? order by `index_name`,`seq_in_index`',[model.__table__])
+	existing = {}   #索引名 => [列名列表,是否unique]
+	for r in rs:
+		existing.setdefault(r['_name_'],[[],not r['_non_unique_']])[0].append(r['_column_'])
+	missing = []
+	for index in model.__indexes__:
+		want = list(index.columns)
+		if index.unique:
+			found = any(unique and columns == want for columns,unique in existing.values())
+		else:
+			found = any(columns[:len(want)] == want for columns,unique in existing.values())
+		if not found:
+			missing.append(index)
+	return missing
+
+#返回Model中有而数据库表中没有的列，表不存在时返回全部列
+async def missing_columns(model):
+	rs = await select('select `column_name` _column_ from information_schema.columns where `table_schema`=database() and `table_name`=?',[model.__table__])
+	columns = set(r['_column_'] for r in rs)
+	return [f.name or k for k,f in model.__mappings__.items() if (f.name or k) not in columns]
+
+#==========================================紧凑行对象=======================================================
+#Model继承dict，每条记录都要创建一个dict，属性访问还要经过__getattr__和KeyError
+#Row是只读的紧凑表示：直接保存游标返回的tuple，每列是一个按下标读取的property，实例只有一个slot，没有__dict__
+#由ModelMetaclass为每个Model生成(Model.__row__)，查询时只取部分列的(见only/defer)另外生成并缓存
+#用法：await Blog.findAll(compact=True)，适合只读的列表页和API；需要修改、保存的记录仍然使用Model实例
+class Row(object):
+	__slots__ = ('_values',)
+	_fields = ()    #列名，和_values中的顺序相同
+
+	def __init__(self,values):
+		self._values = values
+
+	#和dict一样支持row['name']和row.get('name')，模板中两种写法都可以使用
+	def __getitem__(self,key):
+		if key not in self._fields:
+			raise KeyError(key)
+		return getattr(self,key)
+
+	def get(self,key,default=None):
+		return getattr(self,key) if key in self._fields else default
+
+	def keys(self):
+		return self._fields
+
+	def _asdict(self):
+		return dict(zip(self._fields,self._values))
+
+	def __eq__(self,other):
+		return type(self) is type(other) and self._values == other._values
+
+	def __hash__(self):
+		return hash(self._values)
+
+	def __repr__(self):
+		return '%s(%s)'%(self.__class__.__name__,', '.join('%s=%r'%kv for kv in zip(self._fields,self._values)))
+
+def make_row_class(modelName,columns):
+	namespace = {'__slots__':(),'_fields':tuple(columns)}
+	for i,column in enumerate(columns):
+		if column in ('get','keys') or column.startswith('_'):
+			raise ValueError('column name %s of %s conflicts with Row'%(column,modelName))
+		namespace[column] = property(_column_getter(i),doc=column)
+	return type('%sRow'%modelName,(Row,),namespace)
+
+def _column_getter(i):
+	def getter(self):
+		return self._values[i]
+	return getter
+
 #==========================================Model基类区=======================================================
 #定义所有ORM映射的基类Model，使他既可以想字典那样通过[]访问key值，也可以通过.访问key值
 #继承dict是为了使用方便，例如对象实例user['id']即可轻松通过UserModel去数据库获取到id
 #元类自然是为了封装我们之前写的具体的SQL处理函数，从数据库获取数据
 #ORM映射基类，通过Model的父类来构造类
 class Model(dict,metaclass=ModelMetaclass):
+	#子类设置为True后，find()会通过FindLoader合并同一轮事件循环内的查询
+	__batch_find__ = False
+	#查询时通过only/defer没有取出的列，实例上的值通过object.__setattr__设置，不会出现在dict(以及JSON)中
+	__deferred__ = frozenset()
+
 	#这里直接调用了Model的父类dict的初始化方法，把传入的关键字参数存入自身的dict中
 	def __init__(self,**kw):
 		super(Model,self).__init__(**kw)
@@ -169,6 +588,8 @@ class Model(dict,metaclass=ModelMetaclass):
 		try:
 			return self[key]
 		except KeyError:
+			if key in self.__deferred__:
+				raise DeferredFieldError("'%s' was deferred when %s was loaded, use 'await obj.load()' first"%(key,self.__class__.__name__))
 			raise AttributeError(r"'Model' object has no attribute '%s'"%key)
 	def __setattr__(self,key,value):
 		self[key] = value
@@ -185,25 +606,76 @@ class Model(dict,metaclass=ModelMetaclass):
 		return value
 	#==================往Model类添加类方法，就可以让所有子类调用类方法===========================================
 
+	#字段投影：only只取列出的列，defer不取列出的列，主键总是会取出
+	#没有取出的列记录在实例的__deferred__中，需要时用load()/load_many()再加载
+	#返回(select语句,没有取的列)，按参数缓存在__projections__中
+	@classmethod
+	def _projection(cls,only=None,defer=None):
+		if only is None and defer is None:
+			return cls.__select__,()
+		key = (None if only is None else frozenset(only),None if defer is None else frozenset(defer))
+		projection = cls.__projections__.get(key)
+		if projection is None:
+			unknown = (set(only or ()) | set(defer or ())) - set(cls.__mappings__)
+			if unknown:
+				raise ValueError('unknown fields of %s:%s'%(cls.__name__,','.join(sorted(unknown))))
+			fields = [f for f in cls.__fields__ if (only is None or f in only) and not (defer and f in defer)]
+			deferred = tuple(f for f in cls.__fields__ if f not in fields)
+			sql = 'select `%s`%s from `%s`'%(cls.__primary_key__,''.join(',`%s`'%f for f in fields),cls.__table__)
+			projection = cls.__projections__[key] = (sql,deferred)
+		return projection
+
+	#只取部分列时的紧凑行对象的类
+	@classmethod
+	def _row_class(cls,deferred):
+		rowClass = cls.__row_classes__.get(deferred)
+		if rowClass is None:
+			columns = [cls.__primary_key__] + [f for f in cls.__fields__ if f not in deferred]
+			rowClass = cls.__row_classes__[deferred] = make_row_class(cls.__name__,columns)
+		return rowClass
+
+	#由查询结果创建实例，并记下没有取出的列
+	@classmethod
+	def _from_row(cls,row,deferred):
+		obj = cls(**row)
+		if deferred:
+			object.__setattr__(obj,'__deferred__',frozenset(deferred))
+		return obj
+
 	@classmethod  #这个装饰器是类方法的意思，即可以不创建实例直接调用类方法
 	
-	async def find(cls,pk):
+	async def find(cls,pk,only=None,defer=None):
 		''' find object by primary key'''
-		rs = await select('%s where `%s`=?'%(cls.__select__,cls.__primary_key__),[pk],1)
+		if cls.__batch_find__ and only is None and defer is None and _current_transaction() is None:
+			return await get_loader(cls).load(pk)
+		select_sql,deferred = cls._projection(only,defer)
+		rs = await select('%s where `%s`=?'%(select_sql,cls.__primary_key__),[pk],1)
 		if len(rs) == 0:
 			return None
-		return cls(**rs[0])
+		return cls._from_row(rs[0],deferred)
 	
-	#findAll() --根据WHERE条件查找
+	#findAll() --根据WHERE条件查找，only/defer用于只取部分列，见_projection
 	@classmethod	
 	async def findAll(cls,where=None,args=None,**kw):
-		sql = [cls.__select__]
-		if where:
-			sql.append('where')
-			sql.append(where)
 		if args is None:
 			args = []
 		orderBy = kw.get("orderBy",None)
+		select_sql,deferred = cls._projection(kw.get('only',None),kw.get('defer',None))
+		#keyset(游标)分页：after/before是(created_at,主键)元组，用于按created_at降序排列的列表
+		#after取比游标更旧的记录(下一页)，before取比游标更新的记录(上一页)
+		#条件直接走created_at索引(InnoDB二级索引隐含主键，相当于(created_at,id)索引)做范围扫描，不需要offset
+		after = kw.get("after",None)
+		before = kw.get("before",None)
+		if after is not None or before is not None:
+			key,op,direction = (after,'<','desc') if after is not None else (before,'>','asc')
+			seek = '(`created_at`%s? or (`created_at`=? and `%s`%s?))'%(op,cls.__primary_key__,op)
+			where = '(%s) and %s'%(where,seek) if where else seek
+			args = list(args) + [key[0],key[0],key[1]]
+			orderBy = '`created_at` %s,`%s` %s'%(direction,cls.__primary_key__,direction)
+		sql = [select_sql]
+		if where:
+			sql.append('where')
+			sql.append(where)
 		if orderBy:
 			sql.append("order by")
 			sql.append(orderBy)
@@ -212,15 +684,46 @@ class Model(dict,metaclass=ModelMetaclass):
 			sql.append("limit")
 			if isinstance(limit,int):
 				sql.append("?")
-				sql.append(limit)
-			if isinstance(limit,tuple) and len(limit) == 2:
+				args.append(limit)
+			elif isinstance(limit,tuple) and len(limit) == 2:
 				sql.append("?,?")
 				args.extend(limit)  #extend() 函数用于在列表末尾一次性追加另一个序列的多个值
 			else:
 				raise ValueError("错误的limit值:%s"%limit)
 
-		rs = await select(' '.join(sql),args)
-		return [cls(**r) for r in rs]
+		#compact为True时返回只读的紧凑行对象(见Row)
+		compact = kw.get('compact',False)
+		rs = await select(' '.join(sql),args,as_tuple=compact)
+		if before is not None and after is None:
+			rs = list(reversed(rs))   #向前翻页是升序扫描的，这里翻转回降序
+		if compact:
+			return list(map(cls._row_class(deferred),rs))
+		return [cls._from_row(r,deferred) for r in rs]
+	#iterate() -- 根据WHERE条件分批遍历，每次产出batch_size个实例组成的list
+	#用法：async for blogs in Blog.iterate(batch_size=500): ...
+	#与findAll不同，它不会把整张表读入内存，内存占用只和batch_size有关
+	@classmethod
+	async def iterate(cls,where=None,args=None,batch_size=1000,**kw):
+		if batch_size < 1:
+			raise ValueError('batch_size必须大于0:%s'%batch_size)
+		select_sql,deferred = cls._projection(kw.get('only',None),kw.get('defer',None))
+		sql = [select_sql]
+		if where:
+			sql.append('where')
+			sql.append(where)
+		orderBy = kw.get('orderBy',None)
+		if orderBy:
+			sql.append('order by')
+			sql.append(orderBy)
+		compact = kw.get('compact',False)
+		async for rs in select_stream(' '.join(sql),args,batch_size,as_tuple=compact):
+			if compact:
+				yield list(map(cls._row_class(deferred),rs))
+			else:
+				yield [cls._from_row(r,deferred) for r in rs]
+			#每批之间让出事件循环，避免长时间遍历时饿死其他协程
+			await asyncio.sleep(0)
+
 	#findNumber() -- 根据WHERE条件查找，但返回的是整数，适用于select count(*)类型的SQL
 	@classmethod
 	
@@ -233,6 +736,10 @@ class Model(dict,metaclass=ModelMetaclass):
 		if len(rs) == 0:
 			return None
 		return rs[0]['_num_']
+	#findCount() -- 统计符合WHERE条件的记录数，结果经过count_cache缓存，用于分页
+	@classmethod
+	async def findCount(cls,where=None,args=None):
+		return await count_cache.get(cls,where,args)
 	#==========================往Model类型添加实例方法，就可以让所有子类调用实例方法==================================
 	#save、update、remove这三个方法需要管理员权限才能操作，所以不定义为类方法，需要创建实例之后才能调用
 	
@@ -242,11 +749,72 @@ class Model(dict,metaclass=ModelMetaclass):
 		rows = await execute(self.__insert__,args)
 		if rows != 1:
 			logging.warn("无法插入记录，受影响的行:%s"%rows)
+		count_cache.incr(self.__class__,rows)
 	
+	#save_many() -- 批量插入，每chunk_size个对象拼成一条 insert ... values(...),(...) 语句
+	#每个chunk在一个事务中执行，返回总的受影响行数
+	@classmethod
+	async def save_many(cls,objs,chunk_size=500):
+		if chunk_size < 1:
+			raise ValueError('chunk_size必须大于0:%s'%chunk_size)
+		objs = list(objs)
+		total = 0
+		for i in range(0,len(objs),chunk_size):
+			chunk = objs[i:i+chunk_size]
+			args = []
+			for obj in chunk:
+				args.extend(map(obj.getValueOrDefault,cls.__fields__))
+				args.append(obj.getValueOrDefault(cls.__primary_key__))
+			sql = '%s values%s'%(cls.__insert_head__,','.join([cls.__insert_row__]*len(chunk)))
+			rows = await execute(sql,args,autocommit=False)
+			if rows != len(chunk):
+				logging.warn('批量插入记录数不符，期望:%s，受影响的行:%s'%(len(chunk),rows))
+			total += rows
+			count_cache.incr(cls,rows)
+		return total
+
+	#load() -- 加载查询时没有取出的列，names为空时加载全部没有取出的列
+	async def load(self,*names):
+		await self.__class__.load_many([self],*names)
+		return self
+
+	#load_many() -- 为一组实例加载没有取出的列，每_LOADER_MAX_KEYS个主键合并成一条IN查询
+	@classmethod
+	async def load_many(cls,objs,*names):
+		objs = [obj for obj in objs if obj.__deferred__]
+		if not objs:
+			return
+		if not names:
+			names = sorted(set().union(*[obj.__deferred__ for obj in objs]),key=cls.__fields__.index)
+		unknown = set(names) - set(cls.__fields__)
+		if unknown:
+			raise ValueError('unknown fields of %s:%s'%(cls.__name__,','.join(sorted(unknown))))
+		byKey = {}
+		for obj in objs:
+			byKey.setdefault(obj.getValue(cls.__primary_key__),[]).append(obj)
+		keys = list(byKey)
+		for i in range(0,len(keys),_LOADER_MAX_KEYS):
+			chunk = keys[i:i+_LOADER_MAX_KEYS]
+			rs = await select('select `%s`%s from `%s` where `%s` in (%s)'%(cls.__primary_key__,''.join(',`%s`'%n for n in names),
+				cls.__table__,cls.__primary_key__,create_args_string(len(chunk))),chunk)
+			for r in rs:
+				for obj in byKey.get(r[cls.__primary_key__],()):
+					for name in names:
+						obj[name] = r[name]
+		for obj in objs:
+			object.__setattr__(obj,'__deferred__',obj.__deferred__ - set(names))
+
 	async def update(self):
-		args = list(map(self.getValue,self.__fields__))
+		#部分列没有取出时只更新取出的列，不能用默认值覆盖数据库中的内容
+		if self.__deferred__:
+			fields = [f for f in self.__fields__ if f not in self.__deferred__]
+			sql = 'update `%s` set %s where `%s`=?'%(self.__table__,','.join('`%s`=?'%f for f in fields),self.__primary_key__)
+		else:
+			fields,sql = self.__fields__,self.__update__
+		args = list(map(self.getValue,fields))
 		args.append(self.getValue(self.__primary_key__))
-		rows = await execute(self.__update__,args)
+		rows = await execute(sql,args)
+		count_cache.invalidate(self.__class__)
 		if rows != 1:
 			logging.wran('failed to update by primary key: affected rows:%s'%rows)
 	
@@ -255,4 +823,5 @@ class Model(dict,metaclass=ModelMetaclass):
 		rows = await execute(self.__delete__,args)
 		if rows != 1:
 			logging.warn('failed to remove by primary key:affected rows:%s'%rows)
+		count_cache.incr(self.__class__,-rows)
 
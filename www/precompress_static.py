@@ -0,0 +1,50 @@
+#预压缩static目录下的静态文件，为每个可压缩的文件生成.gz(安装了brotli时还有.br)
+#aiohttp的静态文件处理会在客户端支持时直接发送这些文件，每次请求都不用再压缩
+#部署时运行一次：python precompress_static.py [目录]，目录默认为本文件同目录下的static
+#源文件没有变化(压缩文件比源文件新)时跳过；压缩后没有变小的文件不保留压缩版本
+
+import logging; logging.basicConfig(level=logging.INFO)
+import os,sys,gzip
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+#需要压缩的文件类型，图片和woff本身已经是压缩格式了
+COMPRESS_EXTENSIONS = ('.css','.js','.html','.txt','.svg','.otf','.ttf','.eot','.json','.xml')
+
+def compress_file(path,suffix,fn):
+	target = path + suffix
+	if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+		return False
+	with open(path,'rb') as f:
+		data = f.read()
+	compressed = fn(data)
+	if len(compressed) >= len(data):
+		if os.path.exists(target):
+			os.remove(target)
+		return False
+	tmp = target + '.tmp'
+	with open(tmp,'wb') as f:
+		f.write(compressed)
+	os.replace(tmp,target)
+	logging.info('%s: %s => %s bytes'%(target,len(data),len(compressed)))
+	return True
+
+def precompress(root):
+	n = 0
+	for dirpath,dirnames,filenames in os.walk(root):
+		for name in filenames:
+			if not name.lower().endswith(COMPRESS_EXTENSIONS):
+				continue
+			path = os.path.join(dirpath,name)
+			#mtime=0让同样的输入总是得到同样的.gz，便于比较部署产物
+			n += compress_file(path,'.gz',lambda data: gzip.compress(data,compresslevel=9,mtime=0))
+			if brotli is not None:
+				n += compress_file(path,'.br',lambda data: brotli.compress(data,quality=11))
+	return n
+
+if __name__ == '__main__':
+	root = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)),'static')
+	logging.info('%s files compressed under %s'%(precompress(root),root))
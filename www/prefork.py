@@ -0,0 +1,237 @@
+#多进程模式：一个supervisor进程fork出多个worker，每个worker运行自己的事件循环、aiohttp app和数据库连接池
+#每个worker各自用SO_REUSEPORT监听同一个端口，由内核把新连接分配给各个worker，吞吐量可以随CPU核数增长
+#用法：python prefork.py [worker数]
+#  SIGTERM/SIGINT - 所有worker处理完正在进行的请求后退出
+#  SIGHUP         - 滚动重启：逐个启动新worker，新worker就绪后再让旧worker退出，服务不中断
+#worker意外退出时supervisor会自动重新启动它
+#每个worker都由fork后exec的新解释器运行(python prefork.py --worker ...)，supervisor本身不导入app
+#所以SIGHUP之后新worker会加载新的代码、模板和配置；只有prefork.py自身和supervisor的参数(worker数、端口等)的修改需要完全重启
+
+import logging; logging.basicConfig(level=logging.INFO)
+import asyncio,os,sys,signal,socket,select,time
+
+from config import configs
+
+#worker启动后在这个时间(秒)内没有就绪就认为启动失败
+READY_TIMEOUT = 30
+#worker启动后这么快(秒)就退出，说明启动就失败了，重启前等待一下，避免疯狂地fork
+MIN_UPTIME = 5
+
+def bind_socket(host,port):
+	sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+	sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEPORT,1)
+	sock.bind((host,port))
+	sock.listen(1024)
+	sock.setblocking(False)
+	return sock
+
+#worker进程的主函数，返回值为进程的退出码
+def run_worker(host,port,pool_maxsize,render_workers,grace,ready_fd,channel_fd):
+	#在exec出的新解释器中才导入app，滚动重启后的worker运行的是磁盘上最新的代码
+	import orm
+	import cache
+	import renderer
+	import app as application
+	signal.signal(signal.SIGINT,signal.SIG_IGN)   #Ctrl+C由supervisor统一处理
+	signal.signal(signal.SIGTERM,signal.SIG_DFL)
+	signal.signal(signal.SIGHUP,signal.SIG_DFL)
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	app = loop.run_until_complete(application.create_app(loop,pool_maxsize=pool_maxsize,render_workers=render_workers))
+	handler = app.make_handler()
+	srv = loop.run_until_complete(loop.create_server(handler,sock=bind_socket(host,port)))
+	cache.attach(channel_fd,loop)
+	logging.info('worker %s listening on http://%s:%s...'%(os.getpid(),host,port))
+	os.write(ready_fd,b'1')   #通知supervisor已经就绪
+	os.close(ready_fd)
+	loop.add_signal_handler(signal.SIGTERM,loop.stop)
+	loop.run_forever()
+	#优雅退出：先停止接受新连接，再等正在处理的请求完成；退出过程中忽略重复的SIGTERM
+	loop.remove_signal_handler(signal.SIGTERM)
+	signal.signal(signal.SIGTERM,signal.SIG_IGN)
+	logging.info('worker %s shutting down...'%os.getpid())
+	srv.close()
+	loop.run_until_complete(srv.wait_closed())
+	loop.run_until_complete(handler.shutdown(grace))
+	loop.run_until_complete(orm.close_pool())
+	renderer.shutdown_renderer()
+	loop.close()
+	return 0
+
+class Supervisor(object):
+	def __init__(self,workers,host,port,db_pool_budget,grace):
+		self.num_workers = workers
+		self.host = host
+		self.port = port
+		self.grace = grace
+		#数据库连接总数平均分给每个worker；CPU核也平均分给各个worker的渲染进程池
+		self.pool_maxsize = max(1,db_pool_budget // workers)
+		self.render_workers = max(1,(os.cpu_count() or 1) // workers)
+		self.workers = {}   #pid => 启动时间
+		self.channels = {}  #pid => 和worker之间转发缓存作废消息的socket
+		self._stopping = False
+		self._reload = False
+
+	#启动一个worker并等待它就绪，返回(pid,是否就绪)；没有就绪的worker已经被杀掉并回收
+	def spawn(self):
+		r,w = os.pipe()
+		os.set_inheritable(w,True)
+		channel,child_channel = socket.socketpair(socket.AF_UNIX,socket.SOCK_DGRAM)
+		child_channel.set_inheritable(True)
+		pid = os.fork()
+		if pid == 0:
+			os.close(r)
+			try:
+				os.execv(sys.executable,[sys.executable,os.path.abspath(__file__),'--worker',self.host,str(self.port),
+					str(self.pool_maxsize),str(self.render_workers),str(self.grace),str(w),str(child_channel.fileno())])
+			except BaseException as e:
+				logging.exception(e)
+			finally:
+				os._exit(1)
+		os.close(w)
+		child_channel.close()
+		channel.setblocking(False)
+		self.workers[pid] = time.time()
+		self.channels[pid] = channel
+		ready = select.select([r],[],[],READY_TIMEOUT)[0] and os.read(r,1) == b'1'
+		os.close(r)
+		if not ready:
+			logging.error('worker %s failed to start'%pid)
+			self.kill_worker(pid)
+		return pid,ready
+
+	#通知worker退出
+	def signal_worker(self,pid):
+		try:
+			os.kill(pid,signal.SIGTERM)
+		except ProcessLookupError:
+			pass
+
+	#等待worker退出，超时则强制杀掉
+	def wait_worker(self,pid):
+		deadline = time.time() + self.grace + 5
+		try:
+			while time.time() < deadline:
+				if os.waitpid(pid,os.WNOHANG)[0] == pid:
+					break
+				time.sleep(0.1)
+			else:
+				logging.warning('worker %s did not exit in time, killing it'%pid)
+				os.kill(pid,signal.SIGKILL)
+				os.waitpid(pid,0)
+		except ChildProcessError:
+			pass
+		self.forget(pid)
+
+	def stop_worker(self,pid):
+		self.signal_worker(pid)
+		self.wait_worker(pid)
+
+	#没有就绪的worker不需要优雅退出，直接杀掉
+	def kill_worker(self,pid):
+		try:
+			os.kill(pid,signal.SIGKILL)
+			os.waitpid(pid,0)
+		except (ProcessLookupError,ChildProcessError):
+			pass
+		self.forget(pid)
+
+	#worker已经退出，不再管理它
+	def forget(self,pid):
+		channel = self.channels.pop(pid,None)
+		if channel is not None:
+			channel.close()
+		return self.workers.pop(pid,None)
+
+	#把worker发来的缓存作废消息转发给其他worker，最多等待timeout秒
+	def relay(self,timeout):
+		if not self.channels:
+			time.sleep(timeout)
+			return
+		for channel in select.select(list(self.channels.values()),[],[],timeout)[0]:
+			while True:
+				try:
+					data = channel.recv(65536)
+				except BlockingIOError:
+					break
+				if not data:
+					break   #worker已经退出，等reap()回收
+				for other in list(self.channels.values()):
+					if other is channel:
+						continue
+					try:
+						other.send(data)
+					except OSError as e:
+						logging.warning('cache invalidation dropped: %s'%e)
+
+	#滚动重启：每次替换一个worker，任何时候都至少有num_workers个worker在服务
+	#新worker没有就绪(比如新的配置或代码有错)时放弃重启，剩下的旧worker继续服务
+	def rolling_restart(self):
+		logging.info('rolling restart...')
+		for pid in list(self.workers):
+			if not self.spawn()[1]:
+				logging.error('rolling restart aborted, old workers are kept.')
+				return
+			self.stop_worker(pid)
+		logging.info('rolling restart done.')
+
+	#回收退出的worker，再把worker补足到num_workers个(包括之前启动失败的)，返回是否有worker退出
+	def reap(self):
+		reaped = False
+		while self.workers:
+			try:
+				pid,status = os.waitpid(-1,os.WNOHANG)
+			except ChildProcessError:
+				break
+			if pid == 0:
+				break
+			started = self.forget(pid)
+			if started is None:
+				continue
+			reaped = True
+			logging.warning('worker %s exited with status %s, restarting...'%(pid,status))
+			if time.time() - started < MIN_UPTIME:
+				time.sleep(1)
+		while not self._stopping and len(self.workers) < self.num_workers:
+			if not self.spawn()[1]:
+				time.sleep(1)   #启动失败，下一轮循环再试
+				break
+		return reaped
+
+	def run(self):
+		signal.signal(signal.SIGTERM,self._on_stop)
+		signal.signal(signal.SIGINT,self._on_stop)
+		signal.signal(signal.SIGHUP,self._on_reload)
+		logging.info('starting %s workers, %s db connections and %s render processes each...'%(self.num_workers,self.pool_maxsize,self.render_workers))
+		for i in range(self.num_workers):
+			self.spawn()
+		while not self._stopping:
+			if self._reload:
+				self._reload = False
+				self.rolling_restart()
+			self.reap()
+			self.relay(0.5)
+		logging.info('stopping workers...')
+		for pid in list(self.workers):
+			self.signal_worker(pid)
+		for pid in list(self.workers):
+			self.wait_worker(pid)
+
+	def _on_stop(self,signum,frame):
+		self._stopping = True
+
+	def _on_reload(self,signum,frame):
+		self._reload = True
+
+#worker进程的入口：python prefork.py --worker host port pool_maxsize render_workers grace ready_fd channel_fd
+def worker_main(argv):
+	host,port,pool_maxsize,render_workers,grace,ready_fd,channel_fd = argv
+	return run_worker(host,int(port),int(pool_maxsize),int(render_workers),float(grace),int(ready_fd),int(channel_fd))
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1] == '--worker':
+		sys.exit(worker_main(sys.argv[2:]))
+	server = configs.server
+	workers = int(sys.argv[1]) if len(sys.argv) > 1 else (server.workers or os.cpu_count() or 1)
+	Supervisor(workers,server.host,server.port,server.db_pool_budget,server.grace).run()
@@ -0,0 +1,79 @@
+#Markdown渲染服务
+#markdown2是纯python实现的，渲染是CPU密集型的工作，直接在事件循环里渲染一篇很长的博客会卡住所有其他连接
+#这里把较长文本的渲染交给进程池，handler只需要yield from/await渲染结果，事件循环可以继续处理其他请求
+
+import asyncio,os,logging,functools
+from concurrent.futures import ProcessPoolExecutor
+
+import markdown2
+
+from apis import APIError
+
+class RenderBusyError(APIError):
+	'''渲染队列已满'''
+	def __init__(self,message=''):
+		super(RenderBusyError,self).__init__('render:busy','render',message)
+
+class RenderTimeoutError(APIError):
+	'''渲染超时'''
+	def __init__(self,message=''):
+		super(RenderTimeoutError,self).__init__('render:timeout','render',message)
+
+class RenderService(object):
+	def __init__(self,workers=None,inline_below=8192,timeout=10,max_pending=64):
+		'''
+		workers - 进程数，默认为CPU核数
+		inline_below - 文本长度小于这个值时直接在事件循环中渲染，省去进程间传输的开销
+		timeout - 等待渲染结果的最长时间(秒)
+		max_pending - 同时提交到进程池的最大任务数，超过时直接报错而不是无限排队
+		'''
+		self.workers = workers or os.cpu_count() or 1
+		self.inline_below = inline_below
+		self.timeout = timeout
+		self.max_pending = max_pending
+		self._pending = 0
+		self._executor = None
+
+	def start(self):
+		if self._executor is None:
+			logging.info('start render process pool with %s workers...'%self.workers)
+			self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+	def shutdown(self):
+		if self._executor is not None:
+			self._executor.shutdown(wait=False)
+			self._executor = None
+
+	async def markdown(self,text,**kw):
+		if self._executor is None or len(text) < self.inline_below:
+			return markdown2.markdown(text,**kw)
+		if self._pending >= self.max_pending:
+			raise RenderBusyError('Too many pending renders.')
+		self._pending += 1
+		try:
+			loop = asyncio.get_event_loop()
+			fut = loop.run_in_executor(self._executor,functools.partial(markdown2.markdown,text,**kw))
+			#超时后工作进程里的任务仍会跑完，只是不再等待它的结果
+			return await asyncio.wait_for(fut,self.timeout)
+		except asyncio.TimeoutError:
+			logging.warning('render timeout: %s chars'%len(text))
+			raise RenderTimeoutError('Render timed out.')
+		finally:
+			self._pending -= 1
+
+#全局的渲染服务，init_renderer之前所有渲染都在事件循环中直接完成
+_service = RenderService()
+
+def init_renderer(**kw):
+	global _service
+	_service.shutdown()
+	_service = RenderService(**kw)
+	_service.start()
+	return _service
+
+def shutdown_renderer():
+	_service.shutdown()
+
+#在handler中使用：html = yield from renderer.markdown(text)
+async def markdown(text,**kw):
+	return await _service.markdown(text,**kw)
@@ -0,0 +1,44 @@
+#由models.py中的Model生成建表语句，或者检查数据库中缺少的列和索引
+#用法：
+#	python schema.py          输出全部建表语句(schema.sql中的create table部分由它生成)
+#	python schema.py check    连接configs.db中的数据库，列出缺少的列和索引，并输出补建索引的语句
+
+import logging; logging.basicConfig(level=logging.WARNING)
+import sys,asyncio
+
+import orm
+from config import configs
+from models import User,Blog,Comment
+
+MODELS = [User,Blog,Comment]
+
+def print_schema():
+	print('\n\n'.join(orm.create_table_sql(model) for model in MODELS))
+
+async def check(loop):
+	await orm.create_pool(loop=loop,**configs.db)
+	problems = 0
+	try:
+		for model in MODELS:
+			columns = await orm.missing_columns(model)
+			if columns:
+				problems += len(columns)
+				print('-- %s: missing columns: %s' % (model.__table__,', '.join(columns)))
+			for index in await orm.missing_indexes(model):
+				problems += 1
+				print('-- %s: missing index %s' % (model.__table__,index))
+				print(orm.create_index_sql(model,index))
+	finally:
+		await orm.close_pool()
+	if not problems:
+		print('-- schema is up to date')
+	return problems
+
+def main(argv):
+	if len(argv) > 1 and argv[1] == 'check':
+		loop = asyncio.get_event_loop()
+		sys.exit(1 if loop.run_until_complete(check(loop)) else 0)
+	print_schema()
+
+if __name__ == '__main__':
+	main(sys.argv)
@@ -1,4 +1,5 @@
 -- schema.sql
+-- 建表语句由 python schema.py 生成，修改models.py后重新生成
 
 drop database if exists awesome;
 
@@ -29,11 +30,16 @@ create table blogs (
     `name` varchar(50) not null,
     `summary` varchar(200) not null,
     `content` mediumtext not null,
+    `html_content` mediumtext not null,
+    `render_version` varchar(50) not null,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
 
+-- 已有数据库升级:
+-- alter table blogs add column `html_content` mediumtext not null, add column `render_version` varchar(50) not null default '';
+
 create table comments (
     `id` varchar(50) not null,
     `blog_id` varchar(50) not null,
@@ -42,6 +48,10 @@ create table comments (
     `user_image` varchar(500) not null,
     `content` mediumtext not null,
     `created_at` real not null,
+    key `idx_blog_id_created_at` (`blog_id`, `created_at`),
     key `idx_created_at` (`created_at`),
     primary key (`id`)
-) engine=innodb default charset=utf8;
\ No newline at end of file
+) engine=innodb default charset=utf8;
+
+-- 已有数据库升级(python schema.py check 会列出缺少的索引):
+-- create index `idx_blog_id_created_at` on `comments` (`blog_id`, `created_at`);
\ No newline at end of file